@@ -1,12 +1,15 @@
 import re
-from collections import namedtuple
+from collections import namedtuple, deque
 import io
+from itertools import islice
+import os
 import select
 import socket
 import socketserver
 import threading
+import time
 
-Client = namedtuple('Client', 'upstream downstream ev sock_bufs')
+Client = namedtuple('Client', 'upstream downstream ev framers out_bufs events eof')
 
 socks_to_client = {}
 
@@ -15,32 +18,91 @@ poll = select.epoll()
 DOWNSTREAM = ('chat.protohackers.com', 16963)
 #DOWNSTREAM = ('localhost', 9998)
 
+# Bytes queued towards one socket before its peer stops being read
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+
+TONYS_ADDRESS = b'7YWHMfk9JZe0LM0g1ZauHuiSxhI'
+
+# A Boguscoin address is a whole space-delimited token, so the boundaries are
+# lookarounds rather than consumed spaces; that lets adjacent addresses match
+# in the same pass instead of needing a re-scan until nothing changes.
+BOGUSCOIN_RE = re.compile(b'(?<![^ ])(?!' + TONYS_ADDRESS + b')7[A-Za-z0-9]{25,34}(?![^ ])')
+USER_PREFIX_RE = re.compile(b'\\[[A-Za-z0-9]+\\] ')
+
 def do_intercept(chat):
-    while True:
-        new = re.sub(b'(^| )(?!7YWHMfk9JZe0LM0g1ZauHuiSxhI)7[A-Za-z0-9]{25,34}( |$)', b'\\g<1>7YWHMfk9JZe0LM0g1ZauHuiSxhI\\2', chat)
-        if new == chat:
-            break
-        chat = new
-    return new
+    return BOGUSCOIN_RE.sub(TONYS_ADDRESS, chat)
 
 def intercept(msg, is_user):
     if not is_user:
-        m = re.match(b'(\\[[A-Za-z0-9]+\\] )(.*)$', msg)
+        m = USER_PREFIX_RE.match(msg)
         if m:
-            user, chat = m.groups()
-            chat = do_intercept(chat)
-            return user + chat
+            end = m.end()
+            return msg[:end] + do_intercept(msg[end:])
         return msg
     else:
         return do_intercept(msg)
 
+class LineFramer:
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        # Everything already buffered was scanned on an earlier call, so only
+        # the newly arrived bytes can hold a newline
+        start = len(self.buf)
+        self.buf += data
+        nl = self.buf.find(b'\n', start)
+        if nl == -1:
+            return []
+        lines = []
+        begin = 0
+        with memoryview(self.buf) as view:
+            while nl != -1:
+                lines.append(bytes(view[begin:nl]))
+                begin = nl + 1
+                nl = self.buf.find(b'\n', begin)
+        del self.buf[:begin]
+        return lines
+
+class OutBuffer:
+
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+    def __init__(self):
+        self.segments = deque()
+        self.size = 0
+
+    def __bool__(self):
+        return self.size > 0
+
+    def extend(self, segments):
+        for seg in segments:
+            self.segments.append(seg)
+            self.size += len(seg)
+
+    def send(self, sock):
+        segments = self.segments
+        while segments:
+            sent = sock.sendmsg(list(islice(segments, self.IOV_MAX)))
+            self.size -= sent
+            while sent:
+                seg = segments[0]
+                if sent < len(seg):
+                    segments[0] = memoryview(seg)[sent:]
+                    break
+                sent -= len(seg)
+                segments.popleft()
+
 def register(client):
     socks_to_client[client.upstream.fileno()] = (client.downstream, client.upstream, client)
     socks_to_client[client.downstream.fileno()] = (client.upstream, client.downstream, client)
-    client.sock_bufs[client.upstream.fileno()] = b''
-    client.sock_bufs[client.downstream.fileno()] = b''
-    poll.register(client.upstream, select.EPOLLIN | select.EPOLLHUP)
-    poll.register(client.downstream, select.EPOLLIN | select.EPOLLHUP)
+    for sock in (client.upstream, client.downstream):
+        client.framers[sock.fileno()] = LineFramer()
+        client.out_bufs[sock.fileno()] = OutBuffer()
+        client.events[sock.fileno()] = select.EPOLLIN | select.EPOLLHUP
+        poll.register(sock, client.events[sock.fileno()])
 
 def unregister(client):
     del socks_to_client[client.upstream.fileno()]
@@ -51,67 +113,206 @@ def unregister(client):
     client.downstream.close()
     client.ev.set()
 
+class UpstreamPool:
+
+    HEALTH_CHECK_INTERVAL = 5
+
+    def __init__(self, address, size):
+        self.address = address
+        self.size = size
+        self.idle = deque()
+        self.cond = threading.Condition()
+        self.dials = 0
+        self.dial_total = 0.0
+        self.dial_max = 0.0
+
+    def dial(self):
+        start = time.monotonic()
+        sock = socket.create_connection(self.address)
+        elapsed = time.monotonic() - start
+        with self.cond:
+            self.dials += 1
+            self.dial_total += elapsed
+            self.dial_max = max(self.dial_max, elapsed)
+            avg = self.dial_total / self.dials
+            print("Dial upstream %.1fms (avg %.1fms, max %.1fms, n=%d)" % (
+                elapsed * 1000, avg * 1000, self.dial_max * 1000, self.dials))
+        return sock
+
+    @staticmethod
+    def is_closed(sock):
+        # The upstream greets us as soon as we connect, so a peek would find
+        # the banner before any EOF; POLLRDHUP reports the close regardless.
+        p = select.poll()
+        p.register(sock, select.POLLIN | select.POLLRDHUP)
+        for _, flags in p.poll(0):
+            if flags & (select.POLLRDHUP | select.POLLHUP | select.POLLERR):
+                return True
+        return False
+
+    def drop_closed(self):
+        for sock in list(self.idle):
+            if self.is_closed(sock):
+                self.idle.remove(sock)
+                sock.close()
+
+    def acquire(self):
+        with self.cond:
+            while self.idle:
+                sock = self.idle.popleft()
+                self.cond.notify()
+                if not self.is_closed(sock):
+                    return sock
+                sock.close()
+        # Pool ran dry, dial on the caller's thread rather than wait
+        return self.dial()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.drop_closed()
+                if len(self.idle) >= self.size:
+                    self.cond.wait(timeout=self.HEALTH_CHECK_INTERVAL)
+                    continue
+            try:
+                sock = self.dial()
+            except OSError as e:
+                print("Upstream dial failed:", e)
+                time.sleep(1)
+                continue
+            with self.cond:
+                self.idle.append(sock)
+
+upstream_pool = UpstreamPool(DOWNSTREAM, 0)
+
 class Handler(socketserver.BaseRequestHandler):
 
     def handle(self):
-        c_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        c_sock.connect(DOWNSTREAM)
+        c_sock = upstream_pool.acquire()
         self.request.setblocking(False)
         c_sock.setblocking(False)
         ev = threading.Event()
-        client = Client(self.request, c_sock, ev, {})
+        client = Client(self.request, c_sock, ev, {}, {}, {}, set())
         register(client)
         ev.wait()
 
 class Server(socketserver.ThreadingTCPServer):
     allow_reuse_address = True
 
+def update_events(client, sock):
+    # Reading from a socket pauses once the buffer towards its peer passes
+    # HIGH_WATER and resumes when it drains to LOW_WATER, so a slow reader
+    # only ever holds up its own session.
+    fd = sock.fileno()
+    other_end = socks_to_client[fd][0]
+    pending = client.out_bufs[other_end.fileno()].size
+    events = client.events[fd]
+    if fd in client.eof:
+        events &= ~select.EPOLLIN
+    elif events & select.EPOLLIN:
+        if pending >= HIGH_WATER:
+            events &= ~select.EPOLLIN
+    elif pending <= LOW_WATER:
+        events |= select.EPOLLIN
+    if client.out_bufs[fd]:
+        events |= select.EPOLLOUT
+    else:
+        events &= ~select.EPOLLOUT
+    if events != client.events[fd]:
+        client.events[fd] = events
+        poll.modify(sock, events)
+
+def flush(client, sock):
+    try:
+        client.out_bufs[sock.fileno()].send(sock)
+    except io.BlockingIOError:
+        pass
+
+def send_buffered(client, sock, segments):
+    client.out_bufs[sock.fileno()].extend(segments)
+    flush(client, sock)
+
+# Only the poll thread receives, so one scratch buffer serves every socket
+recv_buf = bytearray(8192)
+recv_view = memoryview(recv_buf)
+
 def handle_event(fd, flags):
+    if fd not in socks_to_client:
+        return
     other_end, this_sock, client = socks_to_client[fd]
     is_user = this_sock is client.upstream
-    if flags & select.EPOLLIN == select.EPOLLIN:
-        buf = client.sock_bufs[fd]
-        while True:
-            try:
-                chunk = this_sock.recv(8192)
-                if not chunk:
+    if flags & (select.EPOLLHUP | select.EPOLLERR):
+        unregister(client)
+        return
+    try:
+        if flags & select.EPOLLOUT == select.EPOLLOUT:
+            flush(client, this_sock)
+        if flags & select.EPOLLIN == select.EPOLLIN:
+            framer = client.framers[fd]
+            pending = client.out_bufs[other_end.fileno()]
+            messages = []
+            # Bound the work per event so a fast sender can't starve the
+            # other sessions sharing this thread
+            received = 0
+            while received < HIGH_WATER and pending.size < HIGH_WATER:
+                try:
+                    n = this_sock.recv_into(recv_buf)
+                except io.BlockingIOError:
                     break
-                buf += chunk
-            except io.BlockingIOError:
-                break
-        if not buf:
-            unregister(client)
-        else:
-            messages = buf.split(b'\n')
-            last = messages.pop()
-            if len(last):
-                client.sock_bufs[fd] = last
-            else:
-                client.sock_bufs[fd] = b''
-            forward = b''
-            print(">>> [%d]" % fd, messages)
-            modified = []
-            for msg in messages:
-                inter = intercept(msg, is_user)
-                modified.append(inter)
-                forward += inter + b'\n'
-            print("<<< [%d]" % fd, modified)
-            other_end.sendall(forward)
-    if flags & select.EPOLLHUP == select.EPOLLHUP:
+                if not n:
+                    client.eof.add(fd)
+                    break
+                messages += framer.feed(recv_view[:n])
+                received += n
+            if messages:
+                print(">>> [%d]" % fd, messages)
+                modified = []
+                forward = []
+                for msg in messages:
+                    inter = intercept(msg, is_user)
+                    modified.append(inter)
+                    forward.append(inter)
+                    forward.append(b'\n')
+                print("<<< [%d]" % fd, modified)
+                send_buffered(client, other_end, forward)
+    except OSError:
         unregister(client)
+        return
+    # Either side closing ends the session, but only once whatever it sent
+    # has been passed on.
+    for sock in (this_sock, other_end):
+        peer = socks_to_client[sock.fileno()][0]
+        if sock.fileno() in client.eof and not client.out_bufs[peer.fileno()]:
+            unregister(client)
+            return
+    update_events(client, this_sock)
+    update_events(client, other_end)
 
 def poll_thread():
     while True:
         for event in poll.poll():
             handle_event(*event)
 
-t = threading.Thread(target=poll_thread)
-t.daemon = True
-t.start()
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool-size", type=int, default=8,
+                        help="upstream connections to keep dialled ahead of clients")
+    args = parser.parse_args()
+
+    t = threading.Thread(target=poll_thread)
+    t.daemon = True
+    t.start()
+
+    if args.pool_size > 0:
+        upstream_pool.size = args.pool_size
+        t = threading.Thread(target=upstream_pool.run)
+        t.daemon = True
+        t.start()
 
-server = Server(('0.0.0.0', 40000), Handler)
-try:
-    server.serve_forever()
-finally:
-    for (_, _, client) in socks_to_client.values():
-        client.ev.set()
+    server = Server(('0.0.0.0', 40000), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        for (_, _, client) in socks_to_client.values():
+            client.ev.set()
@@ -0,0 +1,98 @@
+import random
+import re
+import timeit
+
+import challenge_5
+
+TONY = challenge_5.TONYS_ADDRESS
+
+# The rewriter as it was before it was compiled into a single pass, kept here
+# as the oracle for the corpus below.
+def reference_do_intercept(chat):
+    while True:
+        new = re.sub(b'(^| )(?!7YWHMfk9JZe0LM0g1ZauHuiSxhI)7[A-Za-z0-9]{25,34}( |$)', b'\\g<1>7YWHMfk9JZe0LM0g1ZauHuiSxhI\\2', chat)
+        if new == chat:
+            break
+        chat = new
+    return new
+
+def reference_intercept(msg, is_user):
+    if not is_user:
+        m = re.match(b'(\\[[A-Za-z0-9]+\\] )(.*)$', msg)
+        if m:
+            user, chat = m.groups()
+            chat = reference_do_intercept(chat)
+            return user + chat
+        return msg
+    else:
+        return reference_do_intercept(msg)
+
+ALNUM = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+def address(rng, length=None):
+    if length is None:
+        length = rng.randint(26, 35)
+    return b'7' + bytes(rng.choice(ALNUM) for _ in range(length - 1))
+
+CORPUS = [
+    b'',
+    b' ',
+    b'Hi alice, please send payment to 7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX',
+    b'Please pay the ticket price of 15 Boguscoins to one of these addresses: 7YWHMfk9JZe0LM0g1ZauHuiSxhI 7LOrwbDlS8NujgjddyogWgIM93MV5N2VR 7adNeSwJkMakpEcln9HEtthSRtxdmEHOT8T',
+    b'This is a product ID, not a Boguscoin: 7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX-pkWlFLnYnv7V5sTPN8V0dVvZBWCc6U3Df',
+    b'7F1u3wSD5RbOHQmupo9nx4TnhQ',
+    b'7F1u3wSD5RbOHQmupo9nx4TnhQ 7F1u3wSD5RbOHQmupo9nx4TnhQ',
+    b'  7F1u3wSD5RbOHQmupo9nx4TnhQ  7F1u3wSD5RbOHQmupo9nx4TnhQ  ',
+    b'7YWHMfk9JZe0LM0g1ZauHuiSxhIabc',
+    b'too short 7F1u3wSD5RbOHQmupo9nx4Tnh',
+    b'too long 7F1u3wSD5RbOHQmupo9nx4TnhQabcdefghi',
+    b'8F1u3wSD5RbOHQmupo9nx4TnhQ',
+    b'[bob] 7F1u3wSD5RbOHQmupo9nx4TnhQ',
+    b'[bob]  7F1u3wSD5RbOHQmupo9nx4TnhQ',
+    b'* The room contains: alice, bob',
+]
+
+def build_corpus(seed=5, count=2000):
+    rng = random.Random(seed)
+    corpus = list(CORPUS)
+    words = [b'hello', b'pay', b'to', b'', b'[x]', b'7', TONY, TONY + b'x', b'-']
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 12)):
+            r = rng.random()
+            if r < 0.3:
+                parts.append(address(rng))
+            elif r < 0.4:
+                parts.append(address(rng, rng.choice([25, 36, 40])))
+            else:
+                parts.append(rng.choice(words))
+        line = b' '.join(parts)
+        if rng.random() < 0.5:
+            line = b'[user%d] ' % rng.randint(0, 99) + line
+        corpus.append(line)
+    return corpus
+
+def check(corpus):
+    for line in corpus:
+        for is_user in (True, False):
+            expected = reference_intercept(line, is_user)
+            actual = challenge_5.intercept(line, is_user)
+            assert actual == expected, (line, is_user, expected, actual)
+
+def bench(name, func, corpus, number=20):
+    def run():
+        for line in corpus:
+            func(line, True)
+            func(line, False)
+    elapsed = min(timeit.repeat(run, number=number, repeat=3)) / number
+    lines = len(corpus) * 2
+    print('%-10s %8.2f us/line' % (name, elapsed / lines * 1e6))
+    return elapsed
+
+if __name__ == '__main__':
+    corpus = build_corpus()
+    check(corpus)
+    print('corpus: %d lines identical to reference' % (len(corpus) * 2))
+    before = bench('reference', reference_intercept, corpus)
+    after = bench('compiled', challenge_5.intercept, corpus)
+    print('speedup: %.1fx' % (before / after))
@@ -1,10 +1,26 @@
+# Import array for compact typed storage of observations
+from array import array
 # Import bisect for efficient insertion into sorted lists using binary search
 import bisect
+# Import gc to keep the collector out of journal recovery
+import gc
+# Import OrderedDict to evict the least recently observed plates first, deque for ticket queues
+from collections import OrderedDict, deque
+# Import heapq for the deadline-ordered heartbeat schedule
+import heapq
+# Import itertools for a tie-breaking counter in heap entries
+import itertools
+# Import os for journal files and fsync
+import os
 # Import struct for packing and unpacking binary data
 import struct
+# Import sys for measuring the memory used by stored observations
+import sys
+# Import socket for the non-blocking send flag used by heartbeats
+import socket
 # Import socketserver for creating a TCP server with request handling
 import socketserver
-# Import time for handling sleep intervals and timestamps
+# Import time for handling sleep intervals and the monotonic heartbeat clock
 import time
 # Import threading for running background threads, like the heartbeat thread
 import threading
@@ -15,52 +31,337 @@ class ProtocolError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+# Precompiled structs for the wire format (all big-endian)
+U8 = struct.Struct('!B')
+U32 = struct.Struct('!I')
+# IAmCamera body: road, mile, limit
+CAMERA = struct.Struct('!HHH')
+# IAmDispatcher road lists, indexed by the number of roads
+ROAD_LISTS = [struct.Struct('!%dH' % n) for n in range(256)]
+# Ticket body after the plate: road, mile1, timestamp1, mile2, timestamp2, speed
+TICKET = struct.Struct('!HHIHIH')
+
+# Buffered reader that receives in large chunks and decodes whole client messages from them
+class FrameReader:
+    # Receive buffer size; far larger than the biggest message (2 + 255 * 2 bytes)
+    BUFFER_SIZE = 65536
+
+    # Initialize with the client socket
+    def __init__(self, sock):
+        self.sock = sock  # Socket to receive from
+        self.buf = bytearray(self.BUFFER_SIZE)  # Receive buffer
+        self.view = memoryview(self.buf)  # View for recv_into without copies
+        self.start = 0  # Offset of the first undecoded byte
+        self.end = 0  # Offset just past the last received byte
+
+    # Receive more data, moving any partial message to the front first
+    def fill(self):
+        if self.start:
+            pending = self.end - self.start
+            self.buf[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        n = self.sock.recv_into(self.view[self.end:])
+        # If no data, raise exception (connection closed)
+        if not n:
+            raise Exception('Unable to read')
+        self.end += n
+
+    # Return the next (message type, fields) tuple, receiving only when no complete message is buffered
+    def read_message(self):
+        while True:
+            msg = self.decode()
+            if msg is not None:
+                return msg
+            self.fill()
+
+    # Decode one message from the buffer; returns None if it isn't complete yet
+    def decode(self):
+        buf = self.buf
+        start = self.start
+        avail = self.end - start
+        if avail < 1:
+            return None
+        msg_type = buf[start]
+        if msg_type == 0x20:
+            # Plate: str plate, u32 timestamp
+            if avail < 2:
+                return None
+            size = 2 + buf[start + 1] + 4
+            if avail < size:
+                return None
+            plate = str(self.view[start + 2:start + size - 4], 'ascii')
+            (timestamp,) = U32.unpack_from(buf, start + size - 4)
+            fields = (plate, timestamp)
+        elif msg_type == 0x40:
+            # WantHeartbeat: u32 interval
+            size = 5
+            if avail < size:
+                return None
+            fields = U32.unpack_from(buf, start + 1)
+        elif msg_type == 0x80:
+            # IAmCamera: u16 road, u16 mile, u16 limit
+            size = 7
+            if avail < size:
+                return None
+            fields = CAMERA.unpack_from(buf, start + 1)
+        elif msg_type == 0x81:
+            # IAmDispatcher: u8 numroads, u16 roads[numroads]
+            if avail < 2:
+                return None
+            numroads = buf[start + 1]
+            size = 2 + numroads * 2
+            if avail < size:
+                return None
+            fields = (ROAD_LISTS[numroads].unpack_from(buf, start + 2),)
+        else:
+            # Unknown message type; no need to wait for the rest of it
+            raise ProtocolError('Unknown message type')
+        self.start += size  # Consume the message
+        return msg_type, fields
+
 # Global dictionary to store BeatCounter instances, keyed by client ID
 beat_counter = {}
+# Min-heap of (deadline, sequence, BeatCounter) entries, ordered by when the next heartbeat is due
+beat_heap = []
+# Condition guarding beat_heap; notified when a new earliest deadline is pushed
+beat_cond = threading.Condition()
+# Tie-breaker so heap entries with equal deadlines never compare BeatCounter objects
+beat_seq = itertools.count()
+# Number of cancelled entries still sitting in beat_heap
+beat_cancelled = 0
+# Delay before retrying a heartbeat that could not be written immediately
+BEAT_RETRY_DELAY = 0.01
+# Heartbeats due within this many seconds are sent together in one wakeup
+BEAT_SLACK = 0.005
 
-# Class to manage heartbeat counters for clients
+# Class to manage the heartbeat schedule for a client
 class BeatCounter:
     # Initialize with client object and heartbeat interval
     def __init__(self, client, interval):
         self.client = client  # Reference to the client handler
-        self.interval = interval  # Heartbeat interval in beats
-        self.acc = 0  # Accumulator to count beats
+        self.interval = interval / 10  # Heartbeat interval in seconds (protocol sends deciseconds)
+        self.next_due = time.monotonic() + self.interval  # Monotonic time the next heartbeat is due
+        self.cancelled = False  # Set on unregister; the heap entry is then dropped lazily
 
-    # Increment the beat counter and send heartbeat if interval is reached
-    def beat(self):
-        self.acc += 1
-        if self.acc == self.interval:
-            self.acc = 0  # Reset accumulator
-            self.send_beat()  # Send the heartbeat
+    # Advance the schedule after a heartbeat was sent at monotonic time 'now'
+    def advance(self, now):
+        # Step from the previous deadline rather than from now so beats don't drift
+        self.next_due += self.interval
+        # If we fell more than a whole interval behind, resynchronise instead of bursting
+        if self.next_due <= now:
+            self.next_due = now + self.interval
 
-    # Send a heartbeat message to the client
+    # Send a heartbeat message to the client; returns False if it could not be written right now
     def send_beat(self):
-        self.client.send(0x41, b'')  # Send message type 0x41 (heartbeat) with no data
+        return self.client.try_send(0x41, b'')  # Send message type 0x41 (heartbeat) with no data
 
 # Function to register a heartbeat for a client
 def register_heartbeat(client, interval):
     # Create and store a BeatCounter for the client
-    beat_counter[id(client)] = BeatCounter(client, interval)
+    counter = BeatCounter(client, interval)
+    beat_counter[id(client)] = counter
+    with beat_cond:
+        heapq.heappush(beat_heap, (counter.next_due, next(beat_seq), counter))
+        # Wake the scheduler only if this heartbeat is due before everything else
+        if beat_heap[0][2] is counter:
+            beat_cond.notify()
 
 # Function to unregister a heartbeat for a client
 def unregister_heartbeat(client):
-    # Remove the BeatCounter if it exists
-    if id(client) in beat_counter:
-        del beat_counter[id(client)]
+    global beat_cancelled
+    # Remove the BeatCounter if it exists and mark it so the scheduler drops it
+    counter = beat_counter.pop(id(client), None)
+    if counter is not None:
+        with beat_cond:
+            counter.cancelled = True
+            beat_cancelled += 1
+            # Long intervals would keep dead entries around for ages; rebuild once they dominate
+            if beat_cancelled > len(beat_heap) // 2:
+                beat_heap[:] = [entry for entry in beat_heap if not entry[2].cancelled]
+                heapq.heapify(beat_heap)
+                beat_cancelled = 0
 
-# Background thread function to handle periodic heartbeats
+# Background thread function that sends each heartbeat when it is due
 def heartbeat_thread():
-    # Infinite loop to periodically trigger beats
+    global beat_cancelled
+    # Infinite loop, sleeping until the earliest deadline
     while True:
-        time.sleep(.1)  # Sleep for 0.1 seconds between checks
-        # Make a copy of the counters to avoid runtime errors if the dictionary changes during iteration
-        counters = list(beat_counter.values())
-        # Trigger beat for all registered counters, catching exceptions to prevent thread crash
-        for counter in counters:
+        due = []  # Counters whose heartbeat is due now
+        with beat_cond:
+            now = time.monotonic()
+            # Sleep until the earliest deadline (or until a new earlier one is registered)
+            while not beat_heap or beat_heap[0][0] > now:
+                beat_cond.wait(beat_heap[0][0] - now if beat_heap else None)
+                now = time.monotonic()
+            # Pop every entry that is due (or nearly due), dropping cancelled ones
+            while beat_heap and beat_heap[0][0] <= now + BEAT_SLACK:
+                _, _, counter = heapq.heappop(beat_heap)
+                if counter.cancelled:
+                    beat_cancelled = max(beat_cancelled - 1, 0)
+                else:
+                    due.append(counter)
+        # Send outside the lock so registrations never wait on a socket write
+        entries = []
+        for counter in due:
             try:
-                counter.beat()
+                if counter.send_beat():
+                    counter.advance(now)
+                    entries.append((counter.next_due, next(beat_seq), counter))
+                else:
+                    # Socket busy (e.g. mid-ticket): retry shortly without moving the schedule
+                    entries.append((now + BEAT_RETRY_DELAY, next(beat_seq), counter))
             except Exception as e:
+                # Client is gone; its handler will unregister it
                 print("Heartbeat error:", e)
+        # Reschedule the counters that are still registered
+        with beat_cond:
+            for entry in entries:
+                if not entry[2].cancelled:
+                    heapq.heappush(beat_heap, entry)
+
+# Plates whose newest observation is more than this many seconds behind the newest on
+# their shard are forgotten entirely; None (the default) keeps every plate. Only safe when
+# the cameras' timestamps advance together, since a forgotten plate can't be ticketed
+OBSERVATION_WINDOW = None
+
+# Seconds a camera's report may arrive behind the newest observation of its plate; a plate's
+# observations too old to pair into a ticket with anything that late are pruned. None (the
+# default) prunes nothing, since cameras may report in any order
+REPORT_LATENESS = None
+
+# Seconds two observations of a plate may be apart and still be over the limit between
+# cameras up to span miles apart; None if every pair can be (a limit of 0)
+def pairing_window(span, limit):
+    if not limit:
+        return None
+    return -(-span * 3600 // limit)
+
+# Compact, time-sorted log of one plate's observations on one road
+# Each observation is packed into one u64 as (timestamp << 16) | position, so a
+# block is a single typed array that sorts by timestamp
+class ObservationLog:
+    # Maximum observations in a block before it is split in two
+    BLOCK_SIZE = 64
+    # No per-instance __dict__; there is one of these per plate per road
+    __slots__ = ('blocks', 'maxes', 'count')
+
+    # Initialize an empty log
+    def __init__(self):
+        self.blocks = []  # Blocks of packed observations (u64 arrays) in time order
+        self.maxes = []  # Last timestamp of each block, to bisect for the block an insert belongs in
+        self.count = 0  # Total number of observations held
+
+    # Insert an observation; returns its (previous, next) neighbours in time as (pos, time) or None
+    def insert(self, timestamp, pos):
+        self.count += 1
+        packed = (timestamp << 16) | pos
+        # First observation: start the first block
+        if not self.blocks:
+            self.blocks.append(array('Q', [packed]))
+            self.maxes.append(timestamp)
+            return None, None
+        # Find the block to insert into: the first whose last timestamp is after this one
+        b = bisect.bisect(self.maxes, timestamp)
+        if b == len(self.blocks):
+            b -= 1  # Newer than everything: append to the last block
+        block = self.blocks[b]
+        # Insert after every observation with the same timestamp, whatever its position
+        idx = bisect.bisect(block, (timestamp << 16) | 0xFFFF)
+        block.insert(idx, packed)
+        self.maxes[b] = block[-1] >> 16
+        # Previous neighbour, possibly the last entry of the previous block
+        if idx > 0:
+            prev = block[idx - 1]
+        elif b > 0:
+            prev = self.blocks[b - 1][-1]
+        else:
+            prev = None
+        # Next neighbour, possibly the first entry of the next block
+        if idx + 1 < len(block):
+            nxt = block[idx + 1]
+        elif b + 1 < len(self.blocks):
+            nxt = self.blocks[b + 1][0]
+        else:
+            nxt = None
+        # Split an oversized block so inserts stay cheap
+        if len(block) > self.BLOCK_SIZE:
+            half = len(block) // 2
+            self.blocks.insert(b + 1, block[half:])
+            del block[half:]
+            self.maxes[b] = block[-1] >> 16
+            self.maxes.insert(b + 1, self.blocks[b + 1][-1] >> 16)
+        # Unpack neighbours into (position, timestamp)
+        if prev is not None:
+            prev = (prev & 0xFFFF, prev >> 16)
+        if nxt is not None:
+            nxt = (nxt & 0xFFFF, nxt >> 16)
+        return prev, nxt
+
+    # Bulk-load (timestamp, mile) pairs into an empty log
+    def load(self, observations):
+        packed = sorted((timestamp << 16) | pos for timestamp, pos in observations)
+        # Fill blocks half full so the next inserts don't split straight away
+        step = self.BLOCK_SIZE // 2
+        for i in range(0, len(packed), step):
+            block = array('Q', packed[i:i + step])
+            self.blocks.append(block)
+            self.maxes.append(block[-1] >> 16)
+        self.count += len(packed)
+
+    # Drop observations with a timestamp before cutoff
+    def prune(self, cutoff):
+        # Whole blocks first
+        while self.blocks and self.maxes[0] < cutoff:
+            self.count -= len(self.blocks[0])
+            del self.blocks[0]
+            del self.maxes[0]
+        # Then the expired head of the first remaining block
+        if self.blocks:
+            block = self.blocks[0]
+            idx = bisect.bisect_left(block, cutoff << 16)
+            if idx:
+                del block[:idx]
+                self.count -= idx
+
+    # Approximate bytes used by this log
+    def memory(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.blocks) + sys.getsizeof(self.maxes)
+        for block in self.blocks:
+            size += sys.getsizeof(block)
+        return size
+
+# Number of independently locked observation shards per road
+ROAD_SHARDS = 16
+
+# One shard of a road's observations; plates hash to a shard so different plates rarely contend
+class ObservationShard:
+    # Initialize an empty shard
+    def __init__(self):
+        # Observation logs keyed by plate, least recently observed first
+        self.car_observations = OrderedDict()
+        self.newest = 0  # Newest timestamp observed in this shard, for OBSERVATION_WINDOW
+        self.lock = threading.Lock()  # Guards this shard only
+
+    # Drop what can no longer produce a ticket after an observation at timestamp was added to log (lock held)
+    def expire(self, log, timestamp, window):
+        if timestamp > self.newest:
+            self.newest = timestamp
+        if window is None:
+            return
+        # A report at most REPORT_LATENESS behind the plate's newest observation can't be
+        # over the limit with anything more than the pairing window before it
+        if REPORT_LATENESS is not None:
+            log.prune(log.maxes[-1] - REPORT_LATENESS - window)
+        if OBSERVATION_WINDOW is None:
+            return
+        # Evict plates not seen within the window, least recently observed first
+        cutoff = self.newest - max(OBSERVATION_WINDOW, window)
+        while self.car_observations:
+            plate, oldest = next(iter(self.car_observations.items()))
+            if oldest.maxes[-1] >= cutoff:
+                break
+            del self.car_observations[plate]
 
 # Class representing a road with associated cameras, dispatchers, and observations
 class Road:
@@ -69,12 +370,15 @@ class Road:
         self.id = road_id  # Unique road identifier
         self.limit = None  # Speed limit (in mph, set later)
         self.camera_to_pos = {}  # Map camera ID to position (mile marker)
+        self.span = None  # Lowest and highest mile any camera has been at, for the pairing window
         self.position_to_camera = {}  # Map position to camera handler
         self.dispatchers = {}  # Map dispatcher ID to dispatcher handler
-        self.stored_tickets = []  # List to store tickets if no dispatchers are available
-        # Dictionary of car observations, keyed by plate; each value is a tuple of (timestamps, positions) lists
-        self.car_observations = {}
-        self.lock = threading.Lock()  # Lock for thread safety
+        self.stored_tickets = deque()  # Outbound queue of tickets waiting for a dispatcher
+        self.next_dispatcher = 0  # Rotates the starting point so equally loaded dispatchers take turns
+        # Observations, sharded by plate so cameras on the same road only contend on the same plate
+        self.shards = [ObservationShard() for _ in range(ROAD_SHARDS)]
+        # Lock for limit, cameras, dispatchers and stored tickets; never held during I/O
+        self.lock = threading.Lock()
 
     # Set the speed limit for the road
     def set_limit(self, limit):
@@ -82,6 +386,8 @@ class Road:
         with self.lock:
             if self.limit is not None and self.limit != limit:
                 raise ProtocolError('Limit different to previous limit')
+            if self.limit is None:
+                journal_append(REC_LIMIT, (b'L', self.id, limit))  # Persist the first limit set
             self.limit = limit  # Set the limit
 
     # Add a camera to the road at a specific position
@@ -91,6 +397,10 @@ class Road:
             if position in self.position_to_camera:
                 raise ProtocolError('Camera already exists at this location')
             self.position_to_camera[position] = camera  # Map position to camera
+            if self.span is None:
+                self.span = (position, position)
+            else:
+                self.span = (min(self.span[0], position), max(self.span[1], position))
             self.camera_to_pos[id(camera)] = position  # Map camera ID to position
 
     # Add a dispatcher to the road
@@ -98,7 +408,7 @@ class Road:
         with self.lock:
             self.dispatchers[id(dispatcher)] = dispatcher  # Add to dispatchers map
             tickets = list(self.stored_tickets)  # Copy stored tickets
-            self.stored_tickets = []  # Clear stored tickets
+            self.stored_tickets.clear()  # Clear stored tickets
         for ticket in tickets:
             self.send_ticket(ticket)  # Send each stored ticket
 
@@ -116,79 +426,165 @@ class Road:
 
     # Process an observation from a camera
     def camera_observation(self, camera, plate, timestamp):
-        with self.lock:
-            pos = self.camera_to_pos[id(camera)]  # Get position of the camera
+        # Read without the road lock: only this camera's own thread adds or removes its entry
+        pos = self.camera_to_pos[id(camera)]  # Get position of the camera
+        shard = self.shards[hash(plate) % ROAD_SHARDS]  # Shard owning this plate
+        violations = []  # Speeding pairs found; tickets are created after the shard lock is released
+        with shard.lock:
             # Initialize observations for the plate if not present
-            if plate not in self.car_observations:
-                # Store timestamp and position in two synchronized lists
-                self.car_observations[plate] = ([], [])
-            obs_ts, obs_pos = self.car_observations[plate]  # Get timestamps and positions
-            idx = bisect.bisect(obs_ts, timestamp)  # Find insertion index using binary search
-            obs_ts.insert(idx, timestamp)  # Insert timestamp
-            obs_pos.insert(idx, pos)  # Insert position
+            log = shard.car_observations.get(plate)
+            if log is None:
+                log = shard.car_observations[plate] = ObservationLog()
+            else:
+                shard.car_observations.move_to_end(plate)  # Mark as most recently observed
+            prev, nxt = log.insert(timestamp, pos)  # Insert in time order and get neighbours
+            journal_append(REC_OBSERVATION, (b'O', self.id, pos, timestamp), plate)  # Persist the observation
             # Print observations for debugging
-            print("Observations:", plate, list(zip(obs_ts, obs_pos)))
+            print("Observations:", plate, log.count)
             # Calculate speeds and check for violations
-            for speed, obs1, obs2 in get_speeds(idx, obs_ts, obs_pos):
+            for speed, obs1, obs2 in get_speeds(pos, timestamp, prev, nxt):
                 # Print speed for debugging
                 print("Speed", speed, obs1, obs2)
-                # If speed exceeds limit, create a ticket
+                # If speed exceeds limit, remember it for a ticket
                 if round(speed) > self.limit:
-                    self.create_ticket(plate, speed, obs1, obs2)
+                    violations.append((speed, obs1, obs2))
+            shard.expire(log, timestamp, self.pairing_window())
+        # Create tickets outside the shard lock
+        for speed, obs1, obs2 in violations:
+            self.create_ticket(plate, speed, obs1, obs2)
+
+    # Seconds apart two observations can be and still be over the limit on this road
+    def pairing_window(self):
+        span = self.span  # Read once; cameras joining only ever widen it
+        if span is None:
+            return None
+        return pairing_window(span[1] - span[0], self.limit)
 
     # Create a ticket for a speed violation
     def create_ticket(self, plate, speed, obs1, obs2):
         speed_int = int(round(speed * 100))  # Convert speed to integer (mph * 100)
         ticket = (plate, speed_int, obs1, obs2)  # Tuple representing the ticket
-        # Send immediately if dispatchers available, else store
-        if self.dispatchers:
-            self.send_ticket(ticket)
-        else:
+        # Print for debugging
+        print("Maybe send ticket", ticket)
+        # Claim the days now (no duplicate days), so stored tickets are already deduplicated
+        if not should_send_ticket(plate, obs1[1], obs2[1]):
+            return
+        # Persist the claimed days and the ticket until it is delivered
+        journal_append(REC_CLAIM, (b'C', obs1[1] // 86400, obs2[1] // 86400), plate)
+        journal_append(*ticket_record(b'T', self.id, ticket))
+        self.send_ticket(ticket)
+
+    # Add a plate's (timestamp, mile) observations recovered from the journal, without checking for tickets
+    def restore_observations(self, plate, observations):
+        shard = self.shards[hash(plate) % ROAD_SHARDS]  # Shard owning this plate
+        with shard.lock:
+            log = ObservationLog()
+            log.load(observations)
+            shard.car_observations[plate] = log
+            shard.newest = max(shard.newest, log.maxes[-1])
+
+    # Queue a ticket on the least loaded dispatcher, or store it if there are none
+    def send_ticket(self, ticket):
+        with self.lock:
+            # Rotate the candidates so ties are broken round-robin
+            dispatchers = list(self.dispatchers.values())
+            self.next_dispatcher += 1
+            if dispatchers:
+                k = self.next_dispatcher % len(dispatchers)
+                dispatchers = dispatchers[k:] + dispatchers[:k]
+            # Least backlog first; an outbox that was just closed refuses the ticket
+            for dispatcher in sorted(dispatchers, key=lambda d: d.outbox.backlog()):
+                if dispatcher.outbox.put(self, ticket):
+                    # Print for debugging
+                    print("Will send ticket", ticket)
+                    return
             # Print for debugging
             print("Store ticket", ticket)
             self.stored_tickets.append(ticket)  # Store the ticket
 
-    # Send a ticket to a dispatcher
-    def send_ticket(self, ticket):
-        # Print for debugging
-        print("Maybe send ticket", ticket)
-        plate, speed, obs1, obs2 = ticket  # Unpack ticket
-        pos1, time1 = obs1  # Unpack first observation
-        pos2, time2 = obs2  # Unpack second observation
-        # Check if ticket should be sent (no duplicate days)
-        if should_send_ticket(plate, time1, time2):
-            # Print for debugging
-            print("Will send ticket", ticket)
-            # Select the first dispatcher arbitrarily
-            dispatcher = next(iter(self.dispatchers.values()))
-            plate_bytes = plate.encode('ascii')  # Encode plate as ASCII
-            # Pack the message: length of plate, plate, road ID, pos1, time1, pos2, time2, speed
-            msg = struct.pack('!B', len(plate_bytes))
-            msg += plate_bytes
-            msg += struct.pack('!HHIHIH', self.id, pos1, time1, pos2, time2, speed)
-            dispatcher.send(0x21, msg)  # Send message type 0x21 (ticket)
+    # Encode a ticket message body (everything after the message type)
+    def encode_ticket(self, ticket):
+        plate, speed, (pos1, time1), (pos2, time2) = ticket  # Unpack ticket and observations
+        plate_bytes = plate.encode('ascii')  # Encode plate as ASCII
+        # Length of plate, plate, then road ID, pos1, time1, pos2, time2, speed
+        return U8.pack(len(plate_bytes)) + plate_bytes + TICKET.pack(self.id, pos1, time1, pos2, time2, speed)
+
+# Per-dispatcher queue of outbound tickets, written by its own thread in batches
+class TicketOutbox:
+    # Most tickets coalesced into one write
+    MAX_BATCH = 64
+
+    # Initialize for a dispatcher client
+    def __init__(self, client):
+        self.client = client  # Dispatcher handler to write to
+        self.queue = deque()  # Queued (road, ticket) pairs
+        self.cond = threading.Condition()  # Guards queue and closed; signalled when tickets arrive
+        self.closed = False  # Set once the dispatcher is gone; no more tickets are accepted
+
+    # Number of tickets waiting to be written
+    def backlog(self):
+        return len(self.queue)
+
+    # Queue a ticket; returns False if the outbox is closed
+    def put(self, road, ticket):
+        with self.cond:
+            if self.closed:
+                return False
+            self.queue.append((road, ticket))
+            self.cond.notify()
+            return True
+
+    # Close the outbox and return the tickets that were never written
+    def close(self):
+        with self.cond:
+            self.closed = True
+            unsent = list(self.queue)
+            self.queue.clear()
+            self.cond.notify()
+        return unsent
+
+    # Writer thread: send queued tickets, several per write
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.MAX_BATCH))]
+            # Encode and write outside the lock so roads can keep queueing
+            data = b''.join(U8.pack(0x21) + road.encode_ticket(ticket) for road, ticket in batch)
+            try:
+                self.client.send_raw(data)
+            except OSError as e:
+                # Print for debugging
+                print("Dispatcher write failed:", e)
+                # The dispatcher is gone: hand these and anything queued behind them to other dispatchers
+                redeliver(batch + self.close())
+                return
+            # Written: they no longer need redelivering after a restart
+            for road, ticket in batch:
+                journal_append(*ticket_record(b'D', road.id, ticket))
+
+# Function to hand undelivered tickets back to their roads for another dispatcher (or storage)
+def redeliver(entries):
+    for road, ticket in entries:
+        road.send_ticket(ticket)
 
 # Function to calculate speeds between observations
-# Yields up to two speed observations: previous and next
-def get_speeds(idx, times, positions):
-    # If only one observation, no speeds
-    if len(times) == 1:
-        return []
-    pos = positions[idx]  # Current position
-    time_ = times[idx]  # Current timestamp
+# Yields up to two speed observations: with the previous and the next observation in time
+def get_speeds(pos, time_, prev, nxt):
     # Calculate speed with previous observation if exists
-    if idx > 0:
-        prev_pos = positions[idx - 1]
-        prev_time = times[idx - 1]
+    if prev is not None:
+        prev_pos, prev_time = prev
         dist = abs(pos - prev_pos)  # Distance in miles
         t = time_ - prev_time  # Time in seconds
         if t > 0:
             # Yield speed in mph: (distance / time) * 3600
             yield ((dist / t) * 3600, (prev_pos, prev_time), (pos, time_))
     # Calculate speed with next observation if exists
-    if idx < len(times) - 1:
-        new_pos = positions[idx + 1]
-        new_time = times[idx + 1]
+    if nxt is not None:
+        new_pos, new_time = nxt
         dist = abs(new_pos - pos)  # Distance in miles
         t = new_time - time_  # Time in seconds
         if t > 0:
@@ -201,74 +597,396 @@ camera_to_road = {}
 dispatcher_roads = {}
 # Global dictionary mapping road IDs to Road objects
 roads = {}
-# Global dictionary mapping car plates to sets of days they were ticketed
-car_tickets = {}
-# Lock for car_tickets access
-car_lock = threading.Lock()
+# Lock for changes to the registries above; lookups read them without locking
+registry_lock = threading.Lock()
+# Number of independently locked shards of the ticketed-days history
+TICKET_SHARDS = 64
+# Shards of the ticketed-days history, each a dictionary mapping car plates to a packed day bitmap:
+# the low DAY_BITS bits hold the first day in the bitmap and the bits above them mark ticketed days from it
+car_tickets = [{} for _ in range(TICKET_SHARDS)]
+# One lock per car_tickets shard, so ticket decisions for different plates don't contend
+car_locks = [threading.Lock() for _ in range(TICKET_SHARDS)]
+# Width of the base day field; u32 timestamps span fewer than 2**16 days
+DAY_BITS = 16
+DAY_MASK = (1 << DAY_BITS) - 1
+
+# Function to claim the days day_start..day_end for a plate in a dictionary of packed day bitmaps
+# Returns False, changing nothing, if any of those days was already claimed
+def claim_days(plate_days, plate, day_start, day_end):
+    span = (1 << (day_end - day_start + 1)) - 1  # One bit per day spanned
+    packed = plate_days.get(plate)
+    # First claim for this plate: the bitmap starts at its first day
+    if packed is None:
+        plate_days[plate] = (span << DAY_BITS) | day_start
+        return True
+    base = packed & DAY_MASK  # First day covered by the bitmap
+    bits = packed >> DAY_BITS  # Claimed days, bit 0 is the base day
+    # Earlier than anything claimed so far: move the base back
+    if day_start < base:
+        bits <<= base - day_start
+        base = day_start
+    days = span << (day_start - base)  # The days spanned, positioned in the bitmap
+    # If any day already claimed, refuse
+    if bits & days:
+        return False
+    # Update claimed days
+    plate_days[plate] = ((bits | days) << DAY_BITS) | base
+    return True
+
+# Function to list the claimed days of a packed day bitmap as (first day, last day) runs
+def claimed_runs(packed):
+    day = packed & DAY_MASK  # Day of the lowest bit
+    bits = packed >> DAY_BITS
+    while bits:
+        # Skip to the next claimed day, then measure the run of claimed days starting there
+        skip = (bits & -bits).bit_length() - 1
+        bits >>= skip
+        day += skip
+        run = (~bits & (bits + 1)).bit_length() - 1
+        yield day, day + run - 1
+        bits >>= run
+        day += run
 
 # Function to determine if a ticket should be sent (avoids duplicates on the same day)
+# Checks and claims every day from time1 to time2 atomically
 def should_send_ticket(plate, time1, time2):
-    with car_lock:
-        # Initialize set for plate if not present
-        if plate not in car_tickets:
-            car_tickets[plate] = set()
-        day_start = time1 // 86400  # Start day (seconds in a day)
-        day_end = time2 // 86400  # End day
-        days = set()  # Set of days spanned by the observations
-        # Add all days from start to end
-        for day in range(day_start, day_end + 1):
-            days.add(day)
-            # If any day already ticketed, don't send
-            if day in car_tickets[plate]:
-                return False
-        # Update ticketed days
-        car_tickets[plate].update(days)
-        return True
+    shard = hash(plate) % TICKET_SHARDS  # Shard owning this plate
+    with car_locks[shard]:
+        return claim_days(car_tickets[shard], plate, time1 // 86400, time2 // 86400)
+
+# Function to get a road by ID, creating it exactly once if it doesn't exist
+def get_road(road_id):
+    road = roads.get(road_id)  # Lock-free fast path
+    if road is None:
+        with registry_lock:
+            # Check again: another thread may have created it while we waited
+            road = roads.get(road_id)
+            if road is None:
+                road = roads[road_id] = Road(road_id)
+    return road
 
 # Function to register a camera client
 def register_camera(client, road, mile, limit):
     # Print for debugging
     print("Register camera", { 'client': id(client), 'road': road, 'mile': mile, 'limit': limit })
-    # Create road if not exists
-    if road not in roads:
-        roads[road] = Road(road)
-    road_obj = roads[road]  # Get road object
+    road_obj = get_road(road)  # Get or create road object
     road_obj.set_limit(limit)  # Set limit
     road_obj.add_camera(client, mile)  # Add camera
-    camera_to_road[id(client)] = road_obj  # Map client to road
+    with registry_lock:
+        camera_to_road[id(client)] = road_obj  # Map client to road
 
 # Function to unregister a camera client
 def unregister_camera(client):
-    camera_to_road[id(client)].remove_camera(client)  # Remove from road
-    del camera_to_road[id(client)]  # Remove mapping
+    with registry_lock:
+        road_obj = camera_to_road.pop(id(client))  # Remove mapping
+    road_obj.remove_camera(client)  # Remove from road
 
 # Function to register a dispatcher client for multiple roads
 def register_dispatcher(client, in_roads):
     # Print for debugging
     print("Register dispatcher", { 'client': id(client), 'roads': in_roads })
-    road_objs = []  # List of road objects
-    for road in in_roads:
-        # Create road if not exists
-        if road not in roads:
-            roads[road] = Road(road)
-        road_objs.append(roads[road])  # Add to list
-        roads[road].add_dispatcher(client)  # Add dispatcher to road
-    dispatcher_roads[id(client)] = road_objs  # Map client to roads
+    road_objs = [get_road(road) for road in in_roads]  # Get or create road objects
+    # Start the dispatcher's outbox writer before any road can queue tickets on it
+    client.outbox = TicketOutbox(client)
+    t = threading.Thread(target=client.outbox.run)
+    t.daemon = True
+    t.start()
+    with registry_lock:
+        dispatcher_roads[id(client)] = road_objs  # Map client to roads
+    for road_obj in road_objs:
+        road_obj.add_dispatcher(client)  # Add dispatcher to road
 
 # Function to unregister a dispatcher client
 def unregister_dispatcher(client):
-    road_objs = dispatcher_roads[id(client)]  # Get roads
+    with registry_lock:
+        road_objs = dispatcher_roads.pop(id(client))  # Remove mapping
     for road in road_objs:
         road.remove_dispatcher(client)  # Remove from each road
-    del dispatcher_roads[id(client)]  # Remove mapping
+    # Tickets still queued for this dispatcher go to the others (or back into storage)
+    redeliver(client.outbox.close())
+
+# Function to report stored observations as (observation count, approximate bytes)
+def observation_stats():
+    count = 0
+    size = 0
+    for road in list(roads.values()):
+        for shard in road.shards:
+            with shard.lock:
+                size += sys.getsizeof(shard.car_observations)
+                for plate, log in shard.car_observations.items():
+                    count += log.count
+                    size += sys.getsizeof(plate) + log.memory()
+    return count, size
 
 # Function to process a camera observation
 def camera_observation(camera, plate, timestamp):
     # Print for debugging
     print("Observation", { 'camera': id(camera), 'plate': plate, 'timestamp': timestamp })
-    road = camera_to_road[id(camera)]  # Get road
+    road = camera_to_road[id(camera)]  # Get road (lock-free lookup)
     road.camera_observation(camera, plate, timestamp)  # Delegate to road
 
+# Journal record layouts: a type byte, fixed fields, then (where the last field is a length) the plate
+REC_SNAPSHOT = struct.Struct('!cI')  # b'S': last WAL segment folded into this snapshot
+REC_LIMIT = struct.Struct('!cHH')  # b'L': road, limit
+REC_OBSERVATION = struct.Struct('!cHHIB')  # b'O': road, mile, timestamp, plate length
+REC_CLAIM = struct.Struct('!cHHB')  # b'C': first day, last day, plate length
+REC_TICKET = struct.Struct('!cHHHIHIB')  # b'T' queued, b'D' delivered: road, speed, mile1, time1, mile2, time2, plate length
+# Record layout for each type byte, and whether a plate follows it
+RECORD_TYPES = {
+    b'S': (REC_SNAPSHOT, False),
+    b'L': (REC_LIMIT, False),
+    b'O': (REC_OBSERVATION, True),
+    b'C': (REC_CLAIM, True),
+    b'T': (REC_TICKET, True),
+    b'D': (REC_TICKET, True),
+}
+
+# The journal, if persistence is enabled
+journal = None
+
+# Function to queue a journal record if persistence is enabled; cheap enough for the hot path
+def journal_append(layout, fields, plate=None):
+    if journal is not None:
+        journal.append((layout, fields, plate))
+
+# Journal record for a ticket being queued (b'T') or delivered (b'D')
+def ticket_record(kind, road_id, ticket):
+    plate, speed, (pos1, time1), (pos2, time2) = ticket
+    return REC_TICKET, (kind, road_id, speed, pos1, time1, pos2, time2), plate
+
+# Server state folded from journal records, used for both snapshots and recovery
+class JournalState:
+    # Initialize empty state
+    def __init__(self):
+        self.segment = 0  # Last WAL segment folded in
+        self.limits = {}  # Road ID to limit
+        self.observations = {}  # (road ID, plate) to list of (timestamp, mile)
+        self.newest = {}  # Road ID to newest timestamp, for the observation window
+        self.spans = {}  # Road ID to lowest and highest mile observed, for the pairing window
+        self.claims = {}  # Plate to packed day bitmap, as in car_tickets
+        self.pending = {}  # (road ID, ticket) to number queued but not yet delivered
+
+    # Apply one decoded record
+    def apply(self, kind, fields, plate):
+        if kind == b'O':
+            road, pos, timestamp = fields
+            self.observations.setdefault((road, plate), []).append((timestamp, pos))
+            if timestamp > self.newest.get(road, 0):
+                self.newest[road] = timestamp
+            low, high = self.spans.get(road, (pos, pos))
+            self.spans[road] = (min(low, pos), max(high, pos))
+        elif kind == b'C':
+            claim_days(self.claims, plate, *fields)
+        elif kind == b'T' or kind == b'D':
+            road, speed, pos1, time1, pos2, time2 = fields
+            key = (road, (plate, speed, (pos1, time1), (pos2, time2)))
+            count = self.pending.get(key, 0) + (1 if kind == b'T' else -1)
+            if count > 0:
+                self.pending[key] = count
+            else:
+                self.pending.pop(key, None)
+        elif kind == b'L':
+            road, limit = fields
+            self.limits[road] = limit
+        elif kind == b'S':
+            (self.segment,) = fields
+
+    # Observations that can still produce a ticket, as (road ID, plate, [(timestamp, mile), ...]);
+    # the same rule as ObservationShard.expire, by road rather than by shard
+    def live_observations(self):
+        for (road, plate), obs in self.observations.items():
+            low, high = self.spans[road]
+            window = pairing_window(high - low, self.limits.get(road))
+            if window is not None:
+                newest = max(ob[0] for ob in obs)
+                if OBSERVATION_WINDOW is not None and newest < self.newest[road] - max(OBSERVATION_WINDOW, window):
+                    continue
+                if REPORT_LATENESS is not None:
+                    obs = [ob for ob in obs if ob[0] >= newest - REPORT_LATENESS - window]
+            yield road, plate, obs
+
+    # Encode the state as a snapshot: the records that rebuild it
+    def encode(self):
+        out = [REC_SNAPSHOT.pack(b'S', self.segment)]
+        for road, limit in self.limits.items():
+            out.append(REC_LIMIT.pack(b'L', road, limit))
+        for road, plate, obs in self.live_observations():
+            for timestamp, pos in obs:
+                out.append(Journal.encode((REC_OBSERVATION, (b'O', road, pos, timestamp), plate)))
+        for plate, packed in self.claims.items():
+            for first, last in claimed_runs(packed):
+                out.append(Journal.encode((REC_CLAIM, (b'C', first, last), plate)))
+        for (road, ticket), count in self.pending.items():
+            out.extend([Journal.encode(ticket_record(b'T', road, ticket))] * count)
+        return b''.join(out)
+
+    # Load the state into the live server structures (before any client connects)
+    def install(self):
+        for road, limit in self.limits.items():
+            get_road(road).limit = limit
+        for road, plate, obs in self.live_observations():
+            get_road(road).restore_observations(plate, obs)
+        for plate, packed in self.claims.items():
+            car_tickets[hash(plate) % TICKET_SHARDS][plate] = packed
+        for (road, ticket), count in self.pending.items():
+            get_road(road).stored_tickets.extend([ticket] * count)
+
+# Write-ahead log of observations and tickets, with periodic snapshots, so a restart resumes where it stopped
+# The directory holds 'snapshot' plus WAL segments 'wal.<n>'; the snapshot names the last segment it includes
+class Journal:
+    # Seconds between group commits of queued records
+    FLUSH_INTERVAL = 0.05
+
+    # Initialize for a directory, snapshotting every snapshot_interval seconds
+    def __init__(self, directory, snapshot_interval):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.records = deque()  # Records waiting for the writer thread; deque appends need no lock
+        self.segment = 0  # Current WAL segment number
+        self.file = None  # Current WAL segment file
+        self.compactor = None  # Thread writing a snapshot, if one is running
+        os.makedirs(directory, exist_ok=True)
+
+    # Queue a (layout, fields, plate) record for the writer thread
+    def append(self, record):
+        self.records.append(record)
+
+    # Encode a (layout, fields, plate) record
+    @staticmethod
+    def encode(record):
+        layout, fields, plate = record
+        if plate is None:
+            return layout.pack(*fields)
+        plate_bytes = plate.encode('ascii')
+        return layout.pack(*fields, len(plate_bytes)) + plate_bytes
+
+    # Decode records from a file's contents as (kind, fields, plate); stops at a torn or corrupt tail
+    @staticmethod
+    def decode(data):
+        offset = 0
+        end = len(data)
+        while offset < end:
+            kind = data[offset:offset + 1]
+            if kind not in RECORD_TYPES:
+                print("Journal: corrupt record at", offset)
+                return
+            layout, has_plate = RECORD_TYPES[kind]
+            if offset + layout.size > end:
+                return
+            fields = layout.unpack_from(data, offset)[1:]
+            offset += layout.size
+            plate = None
+            if has_plate:
+                size = fields[-1]
+                fields = fields[:-1]
+                if offset + size > end:
+                    return
+                plate = data[offset:offset + size].decode('ascii')
+                offset += size
+            yield kind, fields, plate
+
+    # Path of a file in the journal directory
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # WAL segment numbers present on disk, in order
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal.') and name[4:].isdigit():
+                found.append(int(name[4:]))
+        return sorted(found)
+
+    # Fold the snapshot and the WAL segments up to 'last' (all if None) into a JournalState
+    def load(self, last=None):
+        state = JournalState()
+        try:
+            with open(self.path('snapshot'), 'rb') as f:
+                for record in self.decode(f.read()):
+                    state.apply(*record)
+        except FileNotFoundError:
+            pass
+        covered = state.segment
+        for segment in self.segments():
+            if segment <= covered:
+                # Already in the snapshot; left behind by a crash before it was deleted
+                os.remove(self.path('wal.%08d' % segment))
+                continue
+            if last is not None and segment > last:
+                break
+            with open(self.path('wal.%08d' % segment), 'rb') as f:
+                for record in self.decode(f.read()):
+                    state.apply(*record)
+            state.segment = segment
+        return state
+
+    # Restore the server from disk, then start logging to a fresh segment
+    def recover(self):
+        start = time.monotonic()
+        # Recovery allocates millions of objects that all survive, so collecting during it is wasted work
+        gc.disable()
+        try:
+            state = self.load()
+            state.install()
+        finally:
+            gc.enable()
+        # Keep the recovered state out of future collections too
+        gc.freeze()
+        self.segment = max([state.segment] + self.segments()) + 1
+        self.file = open(self.path('wal.%08d' % self.segment), 'ab')
+        print("Journal: recovered %d observations, %d plates ticketed, %d pending tickets in %.2fs" % (
+            sum(len(obs) for obs in state.observations.values()), len(state.claims),
+            sum(state.pending.values()), time.monotonic() - start))
+
+    # Write every queued record and fsync them as one batch
+    def flush(self):
+        batch = []
+        while self.records:
+            batch.append(self.encode(self.records.popleft()))
+        if batch:
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # Fold segments up to 'last' into a new snapshot, then drop those segments
+    def compact(self, last):
+        state = self.load(last)
+        tmp = self.path('snapshot.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(state.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path('snapshot'))
+        # Make the rename durable before deleting what it replaces
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for segment in self.segments():
+            if segment <= last:
+                os.remove(self.path('wal.%08d' % segment))
+
+    # Writer thread: group-commit records and start a snapshot every snapshot_interval
+    def run(self):
+        last_snapshot = time.monotonic()
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+                if time.monotonic() - last_snapshot >= self.snapshot_interval and \
+                        (self.compactor is None or not self.compactor.is_alive()):
+                    # Switch to a new segment; the finished ones are compacted in the background
+                    self.file.close()
+                    self.segment += 1
+                    self.file = open(self.path('wal.%08d' % self.segment), 'ab')
+                    self.compactor = threading.Thread(target=self.compact, args=(self.segment - 1,))
+                    self.compactor.daemon = True
+                    self.compactor.start()
+                    last_snapshot = time.monotonic()
+            except OSError as e:
+                print("Journal error:", e)
+
 # Handler class for socketserver to manage client connections
 class Handler(socketserver.BaseRequestHandler):
     # Main handle method for the connection
@@ -276,6 +994,7 @@ class Handler(socketserver.BaseRequestHandler):
         self.client_type = None  # Type: 'camera' or 'dispatcher'
         self.heartbeat_known = False  # Flag if heartbeat request processed
         self._send_lock = threading.Lock()  # Lock to serialize sends on this socket
+        self.reader = FrameReader(self.request)  # Buffered message reader for this socket
 
         # Main loop to process messages
         while True:
@@ -285,7 +1004,7 @@ class Handler(socketserver.BaseRequestHandler):
                 # Handle protocol error: send error message
                 err = e.msg.encode('ascii')
                 try:
-                    self.send(0x10, struct.pack('!B', len(err)) + err)  # Send error type 0x10
+                    self.send(0x10, U8.pack(len(err)) + err)  # Send error type 0x10
                     # Sleep (possibly to allow send to complete before close)
                     time.sleep(1)
                 except Exception:
@@ -309,21 +1028,20 @@ class Handler(socketserver.BaseRequestHandler):
 
     # Process one incoming message
     def main_loop(self):
-        msg_type = self.read_u8()  # Read message type
+        msg_type, fields = self.reader.read_message()  # Decode the next message from the buffer
         if msg_type == 0x20:
             # Plate observation message
             # Check if client is a camera
             if self.client_type != 'camera':
                 raise ProtocolError('not a camera')
-            plate = self.read_str()  # Read plate string
-            timestamp = self.read_u32()  # Read timestamp
+            plate, timestamp = fields  # Plate string and timestamp
             camera_observation(self, plate, timestamp)  # Process observation
         elif msg_type == 0x40:
             # WantHeartbeat message
             # Check if already set
             if self.heartbeat_known:
                 raise ProtocolError('Heartbeat already set')
-            interval = self.read_u32()  # Read interval
+            (interval,) = fields  # Interval in deciseconds
             if interval != 0:
                 register_heartbeat(self, interval)  # Register if non-zero
             self.heartbeat_known = True  # Mark as known
@@ -332,9 +1050,7 @@ class Handler(socketserver.BaseRequestHandler):
             # Check if type already set
             if self.client_type is not None:
                 raise ProtocolError('Already classified as another type')
-            road = self.read_u16()  # Read road ID
-            mile = self.read_u16()  # Read mile position
-            limit = self.read_u16()  # Read speed limit
+            road, mile, limit = fields  # Road ID, mile position and speed limit
             register_camera(self, road, mile, limit)  # Register camera
             self.client_type = 'camera'  # Set type
         elif msg_type == 0x81:
@@ -342,62 +1058,74 @@ class Handler(socketserver.BaseRequestHandler):
             # Check if type already set
             if self.client_type is not None:
                 raise ProtocolError('Already classified as another type')
-            numroads = self.read_u8()  # Read number of roads
-            roads = []  # List of roads
-            for _ in range(numroads):
-                roads.append(self.read_u16())  # Read each road ID
-            register_dispatcher(self, roads)  # Register dispatcher
+            (roads,) = fields  # Road IDs
+            register_dispatcher(self, list(roads))  # Register dispatcher
             self.client_type = 'dispatcher'  # Set type
-        else:
-            # Unknown message type
-            raise ProtocolError('Unknown message type')
-
-    # Helper to read unsigned 8-bit integer
-    def read_u8(self):
-        return self._read(1)[0]
-
-    # Helper to read unsigned 16-bit integer (big-endian)
-    def read_u16(self):
-        (val,) = struct.unpack('!H', self._read(2))
-        return val
-
-    # Helper to read unsigned 32-bit integer (big-endian)
-    def read_u32(self):
-        (val,) = struct.unpack('!I', self._read(4))
-        return val
-
-    # Helper to read string (length-prefixed)
-    def read_str(self):
-        l = self.read_u8()  # Read length
-        return self._read(l).decode('ascii')  # Read and decode
-
-    # Internal read method to read exactly 'size' bytes
-    def _read(self, size):
-        buf = b''  # Buffer for data
-        while len(buf) < size:
-            remaining = size - len(buf)  # Bytes left
-            recv = self.request.recv(remaining)  # Receive
-            # If no data, raise exception (connection closed)
-            if not len(recv):
-                raise Exception('Unable to read')
-            buf += recv  # Append
-        return buf
 
     # Send a message with ID and data
     def send(self, msg_id, data):
+        self.send_raw(U8.pack(msg_id) + data)  # Send message ID and data in one write
+
+    # Send already framed messages
+    def send_raw(self, data):
         with self._send_lock:  # Acquire lock to ensure thread-safe sending
-            self.request.send(struct.pack('!B', msg_id))  # Send message ID
-            self.request.sendall(data)  # Send data
+            self.request.sendall(data)
+
+    # Send a message only if it can be written without blocking; returns False otherwise
+    def try_send(self, msg_id, data):
+        # Don't queue behind another send on this socket (e.g. a ticket being written)
+        if not self._send_lock.acquire(blocking=False):
+            return False
+        try:
+            msg = U8.pack(msg_id) + data  # Message ID followed by data
+            try:
+                sent = self.request.send(msg, socket.MSG_DONTWAIT)  # Non-blocking write
+            except BlockingIOError:
+                return False  # Socket buffer full; caller retries later
+            # Finish a partial write so the stream stays framed
+            if sent < len(msg):
+                self.request.sendall(msg[sent:])
+            return True
+        finally:
+            self._send_lock.release()
 
 # Custom server class inheriting from ThreadingTCPServer
 class Server(socketserver.ThreadingTCPServer):
     allow_reuse_address = True  # Allow address reuse for quick restarts
+    request_queue_size = 1024  # Thousands of cameras may connect at once
+
+# Main block
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("listen_port", type=int, nargs="?", default=40000)
+    parser.add_argument("--observation-window", type=int, default=OBSERVATION_WINDOW,
+                        help="forget plates not observed within this many seconds of the newest "
+                             "timestamp on their road (default: keep every plate)")
+    parser.add_argument("--report-lateness", type=int, default=REPORT_LATENESS,
+                        help="prune observations that can't produce a ticket with a report arriving up to "
+                             "this many seconds behind its plate's newest observation (default: keep them all)")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="persist observations and tickets in DIR and recover from it on start")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between journal snapshots")
+    args = parser.parse_args()
+    OBSERVATION_WINDOW = args.observation_window
+    REPORT_LATENESS = args.report_lateness
+
+    # Recover from the journal before accepting clients
+    if args.journal:
+        journal = Journal(args.journal, args.snapshot_interval)
+        journal.recover()
+        t = threading.Thread(target=journal.run)
+        t.daemon = True
+        t.start()
 
-# Create and start the heartbeat thread
-t = threading.Thread(target=heartbeat_thread)
-t.daemon = True  # Daemon thread to exit with main
-t.start()  # Start the thread
+    # Create and start the heartbeat thread
+    t = threading.Thread(target=heartbeat_thread)
+    t.daemon = True  # Daemon thread to exit with main
+    t.start()  # Start the thread
 
-# Create and start the server
-server = Server(('0.0.0.0', 40000), Handler)  # Bind to all interfaces on port 9999
-server.serve_forever()  # Run the server loop
+    # Create and start the server
+    server = Server(('0.0.0.0', args.listen_port), Handler)  # Bind to all interfaces on the listen port
+    server.serve_forever()  # Run the server loop
@@ -0,0 +1,284 @@
+# Benchmarks for the challenge 6 speed daemon internals
+# Run with: python challenge_6_bench.py [heartbeat] [observations] [contention] [tickets] [recovery]
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import challenge_6
+
+# Fake client recording how late each heartbeat was sent relative to its deadline
+class FakeClient:
+    def __init__(self):
+        self.beats = 0
+        self.lateness = []
+
+    def try_send(self, msg_id, data):
+        counter = challenge_6.beat_counter[id(self)]
+        self.lateness.append(time.monotonic() - counter.next_due)
+        self.beats += 1
+        return True
+
+# The 100 ms tick counter the scheduler replaced, used to estimate its sweep cost
+class TickCounter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.acc = 0
+
+    def beat(self):
+        self.acc += 1
+        if self.acc == self.interval:
+            self.acc = 0
+
+def run_heartbeat(cameras, duration, low, high, seed=6):
+    rng = random.Random(seed)
+    intervals = [rng.randint(low, high) for _ in range(cameras)]  # In deciseconds
+
+    # Cost of one sweep of the old tick loop, which ran ten times a second
+    ticks = [TickCounter(i) for i in intervals]
+    start = time.process_time()
+    for counter in ticks:
+        counter.beat()
+    sweep = time.process_time() - start
+
+    clients = [FakeClient() for _ in range(cameras)]
+    for client, interval in zip(clients, intervals):
+        challenge_6.register_heartbeat(client, interval)
+    cpu_start = time.process_time()
+    time.sleep(duration)
+    cpu = time.process_time() - cpu_start
+    for client in clients:
+        challenge_6.unregister_heartbeat(client)
+
+    beats = sum(c.beats for c in clients)
+    expected = sum(int(duration * 10 / i) for i in intervals)
+    lateness = sorted(l for c in clients for l in c.lateness)
+    print('heartbeat: %d cameras, intervals %.0f-%.0fs, %.0fs run' % (cameras, low / 10, high / 10, duration))
+    # The sweep cost excludes sending, which both approaches pay per beat
+    print('  tick loop      %6.1f%% CPU (%.1f ms per 100 ms sweep)' % (sweep * 10 * 100, sweep * 1000))
+    print('  scheduler      %6.1f%% CPU, %d beats (%d due)' % (cpu / duration * 100, beats, expected))
+    if lateness:
+        print('  lateness       p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            lateness[len(lateness) // 2] * 1000,
+            lateness[int(len(lateness) * .99)] * 1000,
+            lateness[-1] * 1000))
+
+def bench_heartbeat(cameras=50000, duration=5.0):
+    threading.Thread(target=challenge_6.heartbeat_thread, daemon=True).start()
+    run_heartbeat(cameras, duration, 10, 100)
+    # Long intervals: almost nothing is due, so the scheduler should stay asleep
+    run_heartbeat(cameras, duration, 600, 6000)
+
+# Stand-in for a camera connection; roads only use its identity
+class FakeCamera:
+    pass
+
+def bench_observations(hours=24, cars_per_minute=60, window=3600, seed=31):
+    rng = random.Random(seed)
+    # Every car makes one trip and the cameras share a clock, so plates can be
+    # forgotten an hour after their last observation
+    challenge_6.OBSERVATION_WINDOW = window
+    challenge_6.roads.clear()
+    challenge_6.camera_to_road.clear()
+    miles = [0, 10, 20, 30]
+    cameras = [FakeCamera() for _ in miles]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for camera, mile in zip(cameras, miles):
+            challenge_6.register_camera(camera, 1, mile, 80)
+    road = challenge_6.roads[1]
+    print('observations: %d h replay, %d cars/min, window %ds' % (hours, cars_per_minute, window))
+    total = 0
+    start = time.process_time()
+    for minute in range(hours * 60):
+        sink = io.StringIO()
+        with contextlib.redirect_stdout(sink):
+            for car in range(cars_per_minute):
+                plate = 'P%07d' % (minute * cars_per_minute + car)
+                t = minute * 60 + rng.randint(0, 59)
+                speed = rng.uniform(40, 79)  # mph, under the limit
+                # Cameras report out of order, so shuffle which one reports first
+                obs = [(camera, t + int(mile / speed * 3600)) for camera, mile in zip(cameras, miles)]
+                rng.shuffle(obs)
+                for camera, ts in obs:
+                    road.camera_observation(camera, plate, ts)
+                    total += 1
+        if (minute + 1) % 180 == 0:
+            count, size = challenge_6.observation_stats()
+            print('  %2dh  %8d seen  %7d stored  %6.1f bytes/observation' % (
+                (minute + 1) // 60, total, count, size / count))
+    elapsed = time.process_time() - start
+    challenge_6.OBSERVATION_WINDOW = None
+    print('  %.1f us per observation' % (elapsed / total * 1e6))
+
+# Dispatcher whose socket write takes a while, like a real client on a busy link
+class SlowDispatcher:
+    # Size of a ticket message for the 9 character plates used below
+    TICKET_SIZE = 1 + 1 + 9 + 16
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.tickets = 0
+        self.writes = 0
+
+    def send_raw(self, data):
+        time.sleep(self.delay)
+        self.tickets += len(data) // self.TICKET_SIZE
+        self.writes += 1
+
+def contention_worker(road, cameras, worker, plates, rng):
+    first, second = cameras
+    for i in range(plates):
+        plate = 'W%03d%05d' % (worker, i)
+        t = rng.randint(0, 3000)  # Within the observation window
+        # One in ten cars is speeding between the two cameras a mile apart
+        gap = 30 if rng.random() < 0.1 else 60
+        road.camera_observation(first, plate, t)
+        road.camera_observation(second, plate, t + gap)
+
+def bench_contention(threads=(1, 2, 4, 8, 16), plates=2000, send_delay=0.0005):
+    print('contention: %d plates per connection, %.1f ms per dispatcher write' % (plates, send_delay * 1000))
+    for n in threads:
+        challenge_6.roads.clear()
+        challenge_6.camera_to_road.clear()
+        for shard in challenge_6.car_tickets:
+            shard.clear()
+        dispatcher = SlowDispatcher(send_delay)
+        pairs = [(FakeCamera(), FakeCamera()) for _ in range(n)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, (first, second) in enumerate(pairs):
+                challenge_6.register_camera(first, 1, 2 * i, 80)
+                challenge_6.register_camera(second, 1, 2 * i + 1, 80)
+            challenge_6.register_dispatcher(dispatcher, [1])
+            road = challenge_6.roads[1]
+            workers = [threading.Thread(target=contention_worker, args=(road, pair, i, plates, random.Random(i)))
+                       for i, pair in enumerate(pairs)]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - start
+            # Let the outbox drain before counting what was written
+            while dispatcher.outbox.backlog():
+                time.sleep(0.01)
+            time.sleep(send_delay * 2)
+            challenge_6.unregister_dispatcher(dispatcher)
+        print('  %2d connections  %8.0f observations/s  %5d tickets in %4d writes' % (
+            n, n * plates * 2 / elapsed, dispatcher.tickets, dispatcher.writes))
+
+# The set-of-days check the bitmap replaced, as a baseline
+set_lock = threading.Lock()
+
+def set_should_send_ticket(car_tickets, plate, time1, time2):
+    with set_lock:
+        if plate not in car_tickets:
+            car_tickets[plate] = set()
+        day_start = time1 // 86400
+        day_end = time2 // 86400
+        days = set()
+        for day in range(day_start, day_end + 1):
+            days.add(day)
+            if day in car_tickets[plate]:
+                return False
+        car_tickets[plate].update(days)
+        return True
+
+def run_tickets(check, calls):
+    # Timed run, then an identical run under tracemalloc to measure what the history holds
+    state = {}
+    start = time.perf_counter()
+    results = [check(state, *call) for call in calls]
+    elapsed = time.perf_counter() - start
+    state.clear()
+    for shard in challenge_6.car_tickets:
+        shard.clear()
+    tracemalloc.start()
+    for call in calls:
+        check(state, *call)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    state.clear()
+    return results, elapsed, size
+
+def bench_tickets(plates=1000000, checks=3, seed=35):
+    rng = random.Random(seed)
+    names = ['T%07d' % i for i in range(plates)]
+    # Each plate is checked a few times over a month; some checks span midnight
+    calls = []
+    for _ in range(checks):
+        for name in names:
+            t1 = rng.randint(0, 30 * 86400)
+            calls.append((name, t1, t1 + rng.choice((60, 600, 86400))))
+    rng.shuffle(calls)
+    print('tickets: %d plates, %d checks' % (plates, len(calls)))
+    expected, elapsed, size = run_tickets(set_should_send_ticket, calls)
+    print('  set of days   %5.2f us/check  %6.1f bytes/plate' % (elapsed / len(calls) * 1e6, size / plates))
+    actual, elapsed, size = run_tickets(lambda state, *call: challenge_6.should_send_ticket(*call), calls)
+    print('  day bitmap    %5.2f us/check  %6.1f bytes/plate' % (elapsed / len(calls) * 1e6, size / plates))
+    assert actual == expected, 'bitmap decisions differ from the set baseline'
+
+def reset_state():
+    challenge_6.roads.clear()
+    challenge_6.camera_to_road.clear()
+    challenge_6.dispatcher_roads.clear()
+    for shard in challenge_6.car_tickets:
+        shard.clear()
+
+def bench_recovery(observations=1000000, roads=100, seed=36):
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix='challenge6-journal-')
+    try:
+        journal = challenge_6.Journal(directory, snapshot_interval=60)
+        # Write the WAL the server would have produced, through the same encoder;
+        # each car passes four cameras on one road
+        records = [(challenge_6.REC_LIMIT, (b'L', road, 80), None) for road in range(roads)]
+        for i in range(observations):
+            plate = 'R%06d' % (i // 4)
+            records.append((challenge_6.REC_OBSERVATION, (b'O', (i // 4) % roads, rng.randint(0, 500), rng.randint(0, 3000)), plate))
+            if i % 40 == 0:
+                records.append((challenge_6.REC_CLAIM, (b'C', 0, 0), plate))
+                records.append(challenge_6.ticket_record(b'T', i % roads, (plate, 9000, (0, 0), (1, 40))))
+        with open(journal.path('wal.00000001'), 'wb') as f:
+            f.write(b''.join(challenge_6.Journal.encode(record) for record in records))
+        size = os.path.getsize(journal.path('wal.00000001'))
+        print('recovery: %d observations, %.1f MB of WAL' % (observations, size / 1e6))
+
+        reset_state()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            journal.recover()
+        print('  from WAL       %5.2f s' % (time.perf_counter() - start))
+        journal.file.close()
+
+        # Same state again, this time from a compacted snapshot
+        journal.compact(journal.segment)
+        size = os.path.getsize(journal.path('snapshot'))
+        reset_state()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            journal.recover()
+        print('  from snapshot  %5.2f s (%.1f MB)' % (time.perf_counter() - start, size / 1e6))
+        journal.file.close()
+        count, _ = challenge_6.observation_stats()
+        print('  %d observations restored' % count)
+    finally:
+        shutil.rmtree(directory)
+        reset_state()
+
+BENCHES = {
+    'heartbeat': bench_heartbeat,
+    'observations': bench_observations,
+    'contention': bench_contention,
+    'tickets': bench_tickets,
+    'recovery': bench_recovery,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
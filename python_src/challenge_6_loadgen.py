@@ -0,0 +1,384 @@
+# Synthetic traffic generator and replay load test for the challenge 6 speed daemon
+# Run with: python challenge_6_loadgen.py [--seed N] [--rate OBS_PER_S] [--server HOST:PORT]
+# Without --server a fresh challenge_6.py is started on a spare port and its RSS is sampled.
+import argparse
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+U8 = struct.Struct('!B')
+U16 = struct.Struct('!H')
+TIMESTAMP = struct.Struct('!I')
+CAMERA = struct.Struct('!BHHH')
+TICKET = struct.Struct('!HHIHIH')
+
+# A car passing some consecutive cameras of one road at a constant speed
+class Trip:
+    def __init__(self, plate, road, speed, observations, offset=0):
+        self.plate = plate
+        self.road = road
+        self.speed = speed
+        self.observations = observations  # [(mile, timestamp)] in time order
+        self.offset = offset  # How far the timestamps are from where the trip is replayed
+
+    # Days of the pairs the server is bound to ticket, each as (first day, last day)
+    def violations(self, limit):
+        days = []
+        for (m1, t1), (m2, t2) in zip(self.observations, self.observations[1:]):
+            if t2 > t1 and round(abs(m2 - m1) / (t2 - t1) * 3600) > limit:
+                days.append((t1 // 86400, t2 // 86400))
+        return days
+
+# A deterministic scenario: roads with cameras, trips over them, and the order
+# everything is replayed in, including dispatchers dropping out and coming back
+class Scenario:
+    def __init__(self, seed, roads, cameras, plates, hours, speeders, repeats, jitter, far, late, dispatchers, outages):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.hours = hours
+        self.jitter = jitter
+
+        # Roads with a limit and cameras 3-15 miles apart
+        self.limits = {}
+        self.cameras = []  # [(road, mile)]
+        self.road_miles = {}
+        per_road = max(2, cameras // roads)
+        for road in rng.sample(range(1, 65536), roads):
+            self.limits[road] = rng.choice((30, 40, 50, 60, 70, 80))
+            mile = rng.randint(0, 1000)
+            miles = []
+            for _ in range(per_road):
+                miles.append(mile)
+                mile += rng.randint(3, 15)
+            self.road_miles[road] = miles
+            self.cameras.extend((road, m) for m in miles)
+        camera_index = {camera: i for i, camera in enumerate(self.cameras)}
+        road_ids = list(self.limits)
+
+        # Trips; some plates make a second trip later on, possibly on the same day
+        horizon = hours * 3600
+        self.trips = []
+        for i in range(plates):
+            plate = 'LG%05d' % i
+            # Some plates are seen at timestamps days to years away from the
+            # others on the same roads, though they are replayed among them
+            offset = 0
+            if rng.random() < far:
+                offset = rng.randrange(horizon + 86400, 2**32 - 2 * horizon - 86400)
+            start = rng.randint(0, horizon)
+            road = None
+            while start < horizon:
+                # Half the repeat trips are on the same road again, like a commute
+                if road is None or rng.random() < 0.5:
+                    road = rng.choice(road_ids)
+                limit = self.limits[road]
+                if rng.random() < speeders:
+                    speed = limit + rng.uniform(5, 40)
+                else:
+                    speed = rng.uniform(max(20, limit - 30), limit - 5)
+                miles = self.road_miles[road]
+                first = rng.randrange(len(miles) - 1)
+                last = rng.randrange(first + 1, len(miles))
+                passed = miles[first:last + 1]
+                if rng.random() < 0.5:
+                    passed.reverse()  # Driving the other way
+                observations = [(m, offset + start + round(abs(m - passed[0]) / speed * 3600)) for m in passed]
+                self.trips.append(Trip(plate, road, speed, observations, offset))
+                if rng.random() >= repeats:
+                    break
+                start = observations[-1][1] - offset + rng.randint(3600, 20 * 3600)
+
+        # Cameras report late by up to `jitter` seconds, so observations of one
+        # plate arrive out of order whenever its cameras are close in time
+        events = []
+        for i, trip in enumerate(self.trips):
+            for mile, ts in trip.observations:
+                events.append((ts - trip.offset + rng.uniform(0, jitter), camera_index[trip.road, mile], trip.plate, ts))
+            # Some trips' last report only arrives after the plate's next trip
+            # has been seen, so it has to pair with observations hours older
+            # than the plate's newest
+            following = self.trips[i + 1] if i + 1 < len(self.trips) else None
+            if following is not None and following.plate == trip.plate and following.road == trip.road \
+                    and rng.random() < late:
+                after = following.observations[-1][1] - following.offset + jitter
+                events[-1] = (after + rng.uniform(0, jitter),) + events[-1][1:]
+        events.sort()
+        self.observations = [event[1:] for event in events]  # [(camera, plate, timestamp)]
+
+        # Each road has a home dispatcher; dispatchers also cover a few others
+        self.dispatchers = [set() for _ in range(dispatchers)]
+        for i, road in enumerate(road_ids):
+            self.dispatchers[i % dispatchers].add(road)
+            self.dispatchers[rng.randrange(dispatchers)].add(road)
+
+        # Outages: (observation index to leave at, index to come back at) per dispatcher
+        n = len(self.observations)
+        self.schedule = []  # [(index, order, 'leave' or 'join', dispatcher)]
+        taken = [[] for _ in range(dispatchers)]
+        for _ in range(outages):
+            d = rng.randrange(dispatchers)
+            start = rng.randrange(n)
+            end = min(n, start + rng.randint(n // 50 + 1, n // 10 + 1))
+            if any(s < end and start < e for s, e in taken[d]):
+                continue
+            taken[d].append((start, end))
+            self.schedule.append((start, 1, 'leave', d))
+            self.schedule.append((end, 0, 'join', d))
+        self.schedule.sort()
+
+    def describe(self):
+        return 'seed %d: %d roads, %d cameras, %d trips, %d observations over %dh, %d dispatchers, %d outages' % (
+            self.seed, len(self.limits), len(self.cameras), len(self.trips), len(self.observations),
+            self.hours, len(self.dispatchers), len(self.schedule) // 2)
+
+# Dispatcher connection collecting the tickets it is sent on a background thread
+class Dispatcher:
+    def __init__(self, address, roads, tickets):
+        self.tickets = tickets  # Shared list of (recv time, plate, road, mile1, ts1, mile2, ts2, speed)
+        self.errors = []
+        self.sock = socket.create_connection(address)
+        self.sock.sendall(U8.pack(0x81) + U8.pack(len(roads)) + b''.join(U16.pack(r) for r in sorted(roads)))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        buf = b''
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            now = time.perf_counter()
+            buf += data
+            while buf:
+                if buf[0] == 0x21:
+                    if len(buf) < 2 or len(buf) < 2 + buf[1] + TICKET.size:
+                        break
+                    end = 2 + buf[1]
+                    self.tickets.append((now, buf[2:end].decode('ascii')) + TICKET.unpack_from(buf, end))
+                    buf = buf[end + TICKET.size:]
+                elif buf[0] == 0x10:
+                    if len(buf) < 2 or len(buf) < 2 + buf[1]:
+                        break
+                    self.errors.append(buf[2:2 + buf[1]].decode('ascii', 'replace'))
+                    buf = buf[2 + buf[1]:]
+                else:
+                    self.errors.append('unexpected message type 0x%02x' % buf[0])
+                    buf = b''
+        self.sock.close()
+
+    # Hang up cleanly: tickets already written to us are still read, the rest
+    # stay with the server, which hands them to another dispatcher
+    def leave(self):
+        self.sock.shutdown(socket.SHUT_WR)
+        self.thread.join()
+
+# Peak and latest resident set size of a process, sampled from /proc
+class RssSampler:
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = self.last = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            with open('/proc/%d/status' % self.pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        self.last = int(line.split()[1]) * 1024
+                        self.peak = max(self.peak, self.last)
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+def start_server(window=None):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'challenge_6.py'), str(port)]
+    if window is not None:
+        command += ['--observation-window', str(window)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process, ('127.0.0.1', port)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+def replay(scenario, address, rate, settle):
+    tickets = []
+    dispatchers = [Dispatcher(address, roads, tickets) for roads in scenario.dispatchers]
+    gone = []  # Dispatchers that left, kept for their errors
+
+    cameras = []
+    for road, mile in scenario.cameras:
+        sock = socket.create_connection(address)
+        sock.sendall(CAMERA.pack(0x80, road, mile, scenario.limits[road]))
+        cameras.append(sock)
+
+    # Send observations at the requested rate, in batches of about 10 ms
+    sent = {}  # (plate, road, mile, ts) -> send time
+    batch = max(1, rate // 100)
+    schedule = list(reversed(scenario.schedule))
+    start = time.perf_counter()
+    for i, (camera, plate, ts) in enumerate(scenario.observations):
+        while schedule and schedule[-1][0] == i:
+            _, _, action, d = schedule.pop()
+            if action == 'leave':
+                dispatchers[d].leave()
+                gone.append(dispatchers[d])
+            else:
+                dispatchers[d] = Dispatcher(address, scenario.dispatchers[d], tickets)
+        if i % batch == 0:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        road, mile = scenario.cameras[camera]
+        encoded = plate.encode('ascii')
+        sent[plate, road, mile, ts] = time.perf_counter()
+        cameras[camera].sendall(b'\x20' + U8.pack(len(encoded)) + encoded + TIMESTAMP.pack(ts))
+    elapsed = time.perf_counter() - start
+    # Outages lasting to the end are over now, so stored tickets go out
+    for _, _, action, d in schedule:
+        dispatchers[d] = Dispatcher(address, scenario.dispatchers[d], tickets)
+
+    # Wait for tickets until none have arrived for `settle` seconds
+    count = -1
+    while count != len(tickets):
+        count = len(tickets)
+        time.sleep(settle)
+    drained = max((t[0] for t in tickets), default=start) - start
+
+    # Cameras are never sent anything unless the server objected to them
+    errors = [e for d in dispatchers + gone for e in d.errors]
+    for sock in cameras:
+        try:
+            if sock.recv(1, socket.MSG_DONTWAIT):
+                errors.append('error sent to a camera')
+        except BlockingIOError:
+            pass
+        sock.close()
+    for d in dispatchers:
+        d.leave()
+    return tickets, sent, elapsed, drained, errors
+
+# Check the tickets against what the server had to do with this scenario
+def check(scenario, tickets, sent):
+    problems = []
+    seen = set(sent)
+    claimed = {}  # plate -> [(first day, last day)]
+    latencies = []
+    for recv_time, plate, road, mile1, ts1, mile2, ts2, speed in tickets:
+        first, second = (plate, road, mile1, ts1), (plate, road, mile2, ts2)
+        if first not in seen or second not in seen or ts1 >= ts2:
+            problems.append('ticket for observations never made: %r' % ((plate, road, mile1, ts1, mile2, ts2),))
+            continue
+        actual = abs(mile2 - mile1) / (ts2 - ts1) * 3600
+        if speed != int(round(actual * 100)) or round(actual) <= scenario.limits[road]:
+            problems.append('ticket with wrong speed %d for %r' % (speed, (plate, road, mile1, ts1, mile2, ts2)))
+        days = (ts1 // 86400, ts2 // 86400)
+        if any(a <= days[1] and days[0] <= b for a, b in claimed.get(plate, ())):
+            problems.append('second ticket on the same day for %s' % plate)
+        claimed.setdefault(plate, []).append(days)
+        latencies.append(recv_time - max(sent[first], sent[second]))
+
+    # Every speeding trip needs a ticket on one of its days, unless another
+    # ticket already took that day
+    speeding = missing = 0
+    for trip in scenario.trips:
+        days = trip.violations(scenario.limits[trip.road])
+        if not days:
+            continue
+        speeding += 1
+        if not any(a <= d2 and d1 <= b for d1, d2 in days for a, b in claimed.get(trip.plate, ())):
+            missing += 1
+            if missing <= 10:
+                problems.append('speeding trip never ticketed: %s on road %d' % (trip.plate, trip.road))
+    return problems, latencies, speeding, missing
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=37)
+    parser.add_argument('--roads', type=int, default=200)
+    parser.add_argument('--cameras', type=int, default=2000, help='total cameras, spread evenly over the roads')
+    parser.add_argument('--plates', type=int, default=20000)
+    parser.add_argument('--hours', type=int, default=30, help='simulated time span; crossing midnight exercises the day rule')
+    parser.add_argument('--speeders', type=float, default=0.2, help='fraction of trips over the limit')
+    parser.add_argument('--repeats', type=float, default=0.3, help='chance a plate makes another trip')
+    parser.add_argument('--jitter', type=float, default=300, help='seconds a camera may report late')
+    parser.add_argument('--far', type=float, default=0.05,
+                        help='fraction of plates seen at timestamps days to years away from the rest')
+    parser.add_argument('--late', type=float, default=0.2,
+                        help='fraction of repeat trips on the same road whose last report arrives after the next trip')
+    parser.add_argument('--dispatchers', type=int, default=20)
+    parser.add_argument('--outages', type=int, default=30, help='dispatcher disconnects during the run')
+    parser.add_argument('--rate', type=int, default=20000, help='observations sent per second')
+    parser.add_argument('--settle', type=float, default=3, help='seconds without tickets before the run ends')
+    parser.add_argument('--server', metavar='HOST:PORT', help='use a running server instead of starting one')
+    parser.add_argument('--pid', type=int, help='process to sample RSS from when using --server')
+    parser.add_argument('--observation-window', type=int,
+                        help='window for the server that is started (default: the server\'s own)')
+    args = parser.parse_args()
+
+    scenario = Scenario(args.seed, args.roads, args.cameras, args.plates, args.hours,
+                        args.speeders, args.repeats, args.jitter, args.far, args.late, args.dispatchers, args.outages)
+    print(scenario.describe())
+
+    process = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+        pid = args.pid
+    else:
+        process, address = start_server(args.observation_window)
+        pid = process.pid
+    sampler = RssSampler(pid) if pid else None
+    try:
+        tickets, sent, elapsed, drained, errors = replay(scenario, address, args.rate, args.settle)
+    finally:
+        if sampler:
+            sampler.stop()
+        if process:
+            process.terminate()
+            process.wait()
+
+    problems, latencies, speeding, missing = check(scenario, tickets, sent)
+    n = len(scenario.observations)
+    print('  observations   %d in %.2fs, %.0f/s (target %d/s)' % (n, elapsed, n / elapsed, args.rate))
+    print('  tickets        %d for %d speeding trips, %d missing, last after %.2fs' % (
+        len(tickets), speeding, missing, drained))
+    if latencies:
+        latencies.sort()
+        print('  latency        p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms' % tuple(
+            percentile(latencies, p) * 1000 for p in (.5, .9, .99, 1)))
+    if sampler:
+        print('  server RSS     peak %.1f MB, end %.1f MB' % (sampler.peak / 2**20, sampler.last / 2**20))
+    for problem in errors + problems:
+        print('  FAIL', problem)
+    return 1 if errors or problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
+import bisect
+import collections
+import heapq
+import itertools
+import os
+import re
 import socket
 import selectors
 import select
+import struct
 import time
 
 def short(d):
@@ -9,26 +16,43 @@ def short(d):
         return s[:100] + " ... " + s[-100:]
     return s
 
+# An application runs on top of each session: the transport calls on_data
+# with every run of newly received in-order bytes and on_close when the
+# session ends, and the app answers through session.send_data
 class LineReversal:
-    def __init__(self):
+    def __init__(self, session):
+        self.session = session
+        # Bytes after the last complete line
+        self.buf = bytearray()
+
+    def on_data(self, data):
+        start = len(self.buf)
+        self.buf += data
+        # Only the new bytes can hold a newline
+        end = self.buf.rfind(b'\n', start) + 1
+        if not end:
+            return
+        lines = self.buf[:end].split(b'\n')
+        lines.pop()
+        del self.buf[:end]
+        self.session.send_data(b''.join(line[::-1] + b'\n' for line in lines))
+
+    def on_close(self):
         pass
 
-    def poll(self):
-        for s in sessions.values():
-            nl = s.recv_buf.find(b'\n')
-            if nl == -1:
-                continue
-            spl = s.recv_buf.split(b'\n')
-            s.recv_buf = spl.pop()
-            for line in spl:
-                l = list(line)
-                l.reverse()
-                rev = bytes(l)
-                s.send_data(rev + b'\n')
-
-app = LineReversal()
+# Creates the application for each new session
+app_factory = LineReversal
 
 sessions = {}
+# Sessions owing their peer an ack; one is sent per batch of datagrams
+pending_acks = set()
+# Bytes held for out-of-order data across all sessions, and the cap on them
+future_bytes = 0
+MAX_FUTURE_BYTES = 16 * 1024 * 1024
+# Heap of (deadline, seq, session); entries whose seq is no longer the
+# session's timer are stale and skipped when they reach the top
+timers = []
+timer_seq = itertools.count()
 
 def valid_int(s):
     try:
@@ -42,32 +66,110 @@ def valid_int(s):
         return None
 
 def fmt_args(m_type, *args):
-    data = b'/' + m_type.encode('ascii') + b'/'
+    # Escape each field once and build the packet with a single join
+    parts = [b'', m_type.encode('ascii')]
     for a in args:
         if type(a) == int:
             if a >= 2147483648:
                 return None
-            a = str(a)
+            parts.append(b'%d' % a)
+            continue
         if type(a) == str:
             a = a.encode('ascii')
-        a = a.replace(b'\\', b'\\\\').replace(b'/', b'\\/')
-        data += a + b'/'
-    return data
+        parts.append(a.replace(b'\\', b'\\\\').replace(b'/', b'\\/'))
+    parts.append(b'')
+    return b'/'.join(parts)
+
+# Clock for every timer; replaceable so simulations can run on virtual time
+clock = time.monotonic
 
 def tick():
-    t = time.time()
-    for session in list(sessions.values()):
+    t = clock()
+    while timers and timers[0][0] <= t:
+        _, seq, session = heapq.heappop(timers)
+        if seq != session.timer:
+            continue
+        session.timer = None
         if session.is_expired(t):
             session.close()
             continue
         if session.needs_retry(t):
             session.retry()
-    app.poll()
+        session.reschedule()
+
+def flush_acks():
+    for session in pending_acks:
+        session.send('ack', session.id, session.recv_len)
+    pending_acks.clear()
+
+def next_timeout():
+    # Seconds until the earliest live deadline, or None to block until a packet arrives
+    while timers and timers[0][1] != timers[0][2].timer:
+        heapq.heappop(timers)
+    if not timers:
+        return None
+    return max(0, timers[0][0] - clock())
+
+class SendBuffer:
+    # Outgoing stream kept as the chunks it was written in, addressed by
+    # absolute offset; acked chunks are dropped whole, nothing is copied
+    def __init__(self):
+        self.chunks = []
+        # Absolute offset of each chunk's first byte
+        self.offsets = []
+        # Index of the oldest chunk still needed
+        self.head = 0
+        self.end = 0
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.offsets.append(self.end)
+            self.end += len(data)
+
+    def release(self, pos):
+        # Forget chunks that end at or before pos
+        head = self.head
+        while head < len(self.chunks) and self.offsets[head] + len(self.chunks[head]) <= pos:
+            self.chunks[head] = None
+            head += 1
+        self.head = head
+        if head > 64 and head * 2 > len(self.chunks):
+            del self.chunks[:head]
+            del self.offsets[:head]
+            self.head = 0
+
+    def read(self, pos, size):
+        # Up to size bytes from pos, copying only those bytes
+        i = bisect.bisect_right(self.offsets, pos, self.head) - 1
+        end = min(pos + size, self.end)
+        parts = []
+        while pos < end:
+            start = self.offsets[i]
+            view = memoryview(self.chunks[i])[pos - start:end - start]
+            parts.append(view)
+            pos += len(view)
+            i += 1
+        return b''.join(parts)
 
 class Session:
 
+    # Retransmit timeout before any RTT has been measured, and its bounds
     RETRY_TIMEOUT = 1
+    MIN_RETRY_TIMEOUT = 0.2
+    MAX_RETRY_TIMEOUT = 10
     EXPIRE_TIMEOUT = 60
+    # Data segments allowed in flight at once
+    WINDOW = 8
+    # Payload bytes per segment after escaping, keeping packets under 1000 bytes
+    SEGMENT_SIZE = 950
+    # Duplicate acks that trigger resending unacknowledged data early
+    DUP_ACKS = 2
+    # Bytes of out-of-order data kept per session until the gap before it fills
+    MAX_FUTURE = 64 * 1024
+    # Bytes charged per held segment on top of its data, roughly what the bytes
+    # object, dict entry and heap slot cost, so tiny segments can't pile up
+    FUTURE_ENTRY = 128
 
     def __init__(self, sess_id, sock, addr):
         self.id = sess_id
@@ -75,18 +177,43 @@ class Session:
         self.addr = addr
         self.closed = False
         self.recv_len = 0
-        self.recv_buf = b''
+        # Data received past recv_len, by position, and a heap of those positions
+        self.future = {}
+        self.future_pos = []
+        self.future_size = 0
         # amount of acknowledged data
         self.send_ack_len = 0
         # Total size we have buffered to send
         self.send_len = 0
-        self.send_buf = b''
+        # Unacknowledged data, from send_ack_len to send_len
+        self.send_buf = SendBuffer()
+        # Offset of the next byte that has never been sent
+        self.send_next = 0
+        # Segments in flight: [start, end, time sent, retransmitted]
+        self.in_flight = collections.deque()
+        # Data below this offset has been sent before, so its acks are not timed
+        self.resent_below = 0
+        self.dup_acks = 0
+        # RTT estimate (RFC 6298); srtt is None until the first sample
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.RETRY_TIMEOUT
         # Timeout counter
         self.ack_timer = None
+        # When to resend unacknowledged data next
+        self.retry_at = None
+        # seq of this session's live entry in timers
+        self.timer = None
+        self.deadline = None
+        self.app = app_factory(self)
 
     def close(self):
         self.send('close', self.id)
         del sessions[self.id]
+        pending_acks.discard(self)
+        self.drop_future()
+        self.app.on_close()
+        self.timer = None
         self.closed = True
 
     def update_last_ack(self):
@@ -95,22 +222,45 @@ class Session:
             self.ack_timer = None
         else:
             # ack received, but still waiting for more
-            self.ack_timer = time.time()
+            self.ack_timer = clock()
+            self.retry_at = self.ack_timer + self.rto
+        self.reschedule()
 
     def update_last_send(self):
         # Start timer if not already
         if self.ack_timer is None:
-            self.ack_timer = time.time()
+            self.ack_timer = clock()
+            self.retry_at = self.ack_timer + self.rto
+            self.reschedule()
+
+    def reschedule(self):
+        # Keep one live heap entry at the earlier of the retry and expiry deadlines
+        if self.ack_timer is None:
+            deadline = None
+        else:
+            deadline = min(self.retry_at, self.ack_timer + self.EXPIRE_TIMEOUT)
+        if deadline == self.deadline and self.timer is not None:
+            return
+        self.deadline = deadline
+        if deadline is None:
+            self.timer = None
+            return
+        self.timer = next(timer_seq)
+        heapq.heappush(timers, (deadline, self.timer, self))
+        # Drop stale entries once they outnumber the sessions
+        if len(timers) > 2 * len(sessions) + 64:
+            timers[:] = [e for e in timers if e[1] == e[2].timer]
+            heapq.heapify(timers)
 
     def is_expired(self, t):
         if self.ack_timer is None:
             return False
-        return t - self.ack_timer > self.EXPIRE_TIMEOUT
+        return t >= self.ack_timer + self.EXPIRE_TIMEOUT
 
     def needs_retry(self, t):
         if self.ack_timer is None:
             return False
-        return t - self.ack_timer > self.RETRY_TIMEOUT
+        return t >= self.retry_at
 
     def send(self, m_type, *args):
         data = fmt_args(m_type, *args)
@@ -120,70 +270,172 @@ class Session:
 
     def on_data(self, data, pos):
         if pos > self.recv_len:
-            # This is future data, ignore
-            self.send('ack', self.id, self.recv_len)
+            # Future data: keep it for when the gap is filled, and ack what we have
+            self.store_future(data, pos)
+            pending_acks.add(self)
             return
         # How much of this data have we already received
         overlap = self.recv_len - pos
         # any new data from this packet
-        new_data = data[overlap:]
+        new_data = memoryview(data)[overlap:]
         self.recv_len += len(new_data)
         if len(new_data):
-            self.recv_buf += new_data
-        self.send('ack', self.id, self.recv_len)
+            self.app.on_data(new_data)
+            if self.future:
+                self.merge_future()
+        pending_acks.add(self)
 
-    def on_ack(self, l):
-        # ack for previous data
-        if l <= self.send_ack_len:
-            print("Ignoring ack (prev data)")
+    def store_future(self, data, pos):
+        global future_bytes
+        held = self.future.get(pos)
+        if held is not None and len(held) >= len(data):
             return
+        if held is None:
+            grow = len(data) + self.FUTURE_ENTRY
+        else:
+            grow = len(data) - len(held)
+        if self.future_size + grow > self.MAX_FUTURE or future_bytes + grow > MAX_FUTURE_BYTES:
+            return  # Over a limit: dropped, the peer will resend it
+        if held is None:
+            heapq.heappush(self.future_pos, pos)
+        self.future[pos] = data
+        self.future_size += grow
+        future_bytes += grow
+
+    def merge_future(self):
+        # Pass on held segments that now start at or before recv_len, as one run
+        global future_bytes
+        run = []
+        while self.future_pos and self.future_pos[0] <= self.recv_len:
+            pos = heapq.heappop(self.future_pos)
+            data = self.future.pop(pos)
+            freed = len(data) + self.FUTURE_ENTRY
+            self.future_size -= freed
+            future_bytes -= freed
+            if pos + len(data) > self.recv_len:
+                run.append(memoryview(data)[self.recv_len - pos:])
+                self.recv_len = pos + len(data)
+        if run:
+            self.app.on_data(run[0] if len(run) == 1 else b''.join(run))
+
+    def drop_future(self):
+        global future_bytes
+        future_bytes -= self.future_size
+        self.future.clear()
+        self.future_pos.clear()
+        self.future_size = 0
+
+    def on_ack(self, l):
         # unexpected ack
         if l > self.send_len:
             self.close()
             return
-        # length of data confirmed by ack
-        conf = l - self.send_ack_len
-        self.send_buf = self.send_buf[conf:]
+        # ack for previous data
+        if l <= self.send_ack_len:
+            # The peer is missing the oldest segment but getting later ones
+            if l == self.send_ack_len and self.in_flight:
+                self.dup_acks += 1
+                if self.dup_acks == self.DUP_ACKS:
+                    self.rewind()
+                    return
+            print("Ignoring ack (prev data)")
+            return
+        self.send_buf.release(l)
         self.send_ack_len = l
+        self.dup_acks = 0
+        # Retire acknowledged segments, timing the newest one unless it was resent (Karn)
+        sample = None
+        now = clock()
+        while self.in_flight and self.in_flight[0][1] <= l:
+            start, end, sent, retransmitted = self.in_flight.popleft()
+            sample = None if retransmitted else now - sent
+        if self.in_flight and self.in_flight[0][0] < l:
+            self.in_flight[0][0] = l
+        if sample is not None:
+            self.update_rtt(sample)
         self.update_last_ack()
-        # not all the data was confirmed, send the rest again
-        if l < self.send_len:
-            self.retry()
+        # The window has room again
+        self.fill_window()
+
+    def update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(self.MAX_RETRY_TIMEOUT, max(self.MIN_RETRY_TIMEOUT, self.srtt + 4 * self.rttvar))
 
     def retry(self):
-        trunc = self.send_buf[:950]
-        self.send('data', self.id, self.send_ack_len, trunc)
+        # Timed out: back off and resend what is still unacknowledged
+        self.rto = min(self.MAX_RETRY_TIMEOUT, self.rto * 2)
+        self.rewind()
+        self.retry_at = clock() + self.rto
+
+    def rewind(self):
+        # Receivers drop data past a gap, so everything after the oldest
+        # unacknowledged byte goes out again
+        self.resent_below = max(self.resent_below, self.send_next)
+        self.send_next = self.send_ack_len
+        self.in_flight.clear()
+        self.fill_window()
+
+    def segment_at(self, pos):
+        # The next segment's payload; escaping grows it, so leave room for that
+        data = self.send_buf.read(pos, self.SEGMENT_SIZE)
+        if len(data) + data.count(b'\\') + data.count(b'/') <= self.SEGMENT_SIZE:
+            return data
+        # Longest prefix that fits once escaped; half a segment always does,
+        # even if every byte needs escaping
+        low, high = self.SEGMENT_SIZE // 2, len(data) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            head = data[:mid]
+            if mid + head.count(b'\\') + head.count(b'/') <= self.SEGMENT_SIZE:
+                low = mid
+            else:
+                high = mid - 1
+        return data[:low]
+
+    def fill_window(self):
+        while len(self.in_flight) < self.WINDOW and self.send_next < self.send_len:
+            start = self.send_next
+            data = self.segment_at(start)
+            self.send_next += len(data)
+            self.in_flight.append([start, self.send_next, clock(), start < self.resent_below])
+            self.send('data', self.id, start, data)
 
     def send_data(self, data):
-        self.send_buf += data
-        trunc = self.send_buf[:950]
-        self.update_last_send()
-        self.send('data', self.id, self.send_ack_len, trunc)
+        self.send_buf.append(data)
         self.send_len += len(data)
+        self.update_last_send()
+        self.fill_window()
+
+# One field: runs of plain bytes or escape sequences (a trailing backslash escapes nothing)
+FIELD_RE = re.compile(rb'(?:[^\\/]+|\\.?)*', re.S)
 
-def unescape_split(data):
-    esc = False
-    cur = b''
+def unescape_split(data, maxsplit=-1):
+    # Without escapes the fields are plain slices of the packet
+    if b'\\' not in data:
+        return data.split(b'/', maxsplit)
     fields = []
-    for c in data:
-        if c == b'\\'[0]:
-            if esc:
-                cur += b'\\'
-                esc = False
-            else:
-                esc = True
-            continue
-        if esc:
-            cur += bytes([c])
-            esc = False
-            continue
-        if c == b'/'[0]:
-            fields.append(cur)
-            cur = b''
-        else:
-            cur += bytes([c])
-    fields.append(cur)
-    return fields
+    pos = 0
+    n = len(data)
+    while True:
+        # Like bytes.split, the rest after maxsplit splits is left as it is
+        if len(fields) == maxsplit:
+            fields.append(data[pos:])
+            return fields
+        end = FIELD_RE.match(data, pos).end()
+        field = data[pos:end]
+        if b'\\' in field:
+            # Escaped backslashes pair up from the left, so once they are split
+            # out every remaining backslash just escapes the byte after it
+            field = b'\\'.join([p.replace(b'\\', b'') for p in field.split(b'\\\\')])
+        fields.append(field)
+        if end == n:
+            return fields
+        pos = end + 1
 
 def recv_packet(sock, data, address):
     if len(data) < 3 or len(data) >= 1000:
@@ -264,17 +516,106 @@ def recv_packet(sock, data, address):
         print("Drop invalid (type)", data)
 
 
-if __name__ == '__main__':
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('0.0.0.0', 40000))
+# Client address in front of a datagram steered to a worker
+STEERED = struct.Struct('!4sH')
+
+def serve(sock, batch, inbox=None):
+    # Packets come from the UDP socket, or from the dispatcher over inbox;
+    # replies always go out on the UDP socket
+    source = sock if inbox is None else inbox
+    source.setblocking(False)
     selector = selectors.EpollSelector()
-    selector.register(sock, selectors.EVENT_READ)
-    try:
-        while True:
-            ready = selector.select(timeout=1)
-            if len(ready):
-                data, address = sock.recvfrom(8192)
+    selector.register(source, selectors.EVENT_READ)
+    while True:
+        ready = selector.select(timeout=next_timeout())
+        if len(ready):
+            # Drain what is queued, up to a batch, then answer it all at once
+            for _ in range(batch):
+                try:
+                    if inbox is None:
+                        data, address = sock.recvfrom(8192)
+                    else:
+                        msg = inbox.recv(STEERED.size + 8192)
+                        if not msg:
+                            return  # Dispatcher is gone
+                        host, port = STEERED.unpack_from(msg)
+                        data, address = msg[STEERED.size:], (socket.inet_ntoa(host), port)
+                except BlockingIOError:
+                    break
                 recv_packet(sock, data, address)
-            tick()
-    finally:
-        sock.close()
+        flush_acks()
+        tick()
+
+def dispatch(sock, inboxes):
+    # Steer each datagram to the worker owning its session ID, so a session's
+    # state stays in one process; anything unparseable goes to worker 0 to be dropped
+    live = list(inboxes)  # None once a worker is gone
+    while any(live):
+        data, address = sock.recvfrom(8192)
+        # Unescaped as the worker will, so both see the same session ID
+        fields = unescape_split(data, 3)
+        session = valid_int(fields[2]) if len(fields) == 4 else None
+        worker = (session or 0) % len(live)
+        inbox = live[worker]
+        if inbox is None:
+            continue  # Its sessions went with it; their peers will time out
+        try:
+            inbox.send(STEERED.pack(socket.inet_aton(address[0]), address[1]) + data, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # Worker is behind and its inbox is full: drop the datagram, as the
+            # network might have, rather than stall every other worker
+            pass
+        except (BrokenPipeError, ConnectionResetError):
+            print("Worker", worker, "is gone")
+            live[worker] = None
+
+def start_workers(sock, count, batch):
+    pids = []
+    inboxes = []
+    for _ in range(count):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for inbox in inboxes:
+                inbox.close()
+            try:
+                serve(sock, batch, child_end)
+            finally:
+                os._exit(0)
+        child_end.close()
+        pids.append(pid)
+        inboxes.append(parent_end)
+    return pids, inboxes
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("listen_port", nargs="?", type=int, default=40000)
+    parser.add_argument("--batch", type=int, default=256,
+                        help="datagrams read per wakeup before acks and replies are sent")
+    parser.add_argument("--window", type=int, default=Session.WINDOW,
+                        help="data segments each session keeps in flight")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes owning sessions by ID (default: serve in this process)")
+    args = parser.parse_args()
+    Session.WINDOW = args.window
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', args.listen_port))
+    if not args.workers:
+        try:
+            serve(sock, args.batch)
+        finally:
+            sock.close()
+    else:
+        pids, inboxes = start_workers(sock, args.workers, args.batch)
+        try:
+            dispatch(sock, inboxes)
+        finally:
+            # Workers exit once their inbox closes
+            for inbox in inboxes:
+                inbox.close()
+            for pid in pids:
+                os.waitpid(pid, 0)
+            sock.close()
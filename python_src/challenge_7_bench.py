@@ -0,0 +1,497 @@
+# Benchmarks for the challenge 7 LRCP layer
+# Run with: python challenge_7_bench.py [codec] [window] [buffers] [throughput] [reorder]
+import contextlib
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+
+import challenge_7
+
+# The byte-at-a-time parser and chained-replace serializer the codec replaced,
+# kept as the oracle for the packets below
+def reference_unescape_split(data):
+    esc = False
+    cur = b''
+    fields = []
+    for c in data:
+        if c == b'\\'[0]:
+            if esc:
+                cur += b'\\'
+                esc = False
+            else:
+                esc = True
+            continue
+        if esc:
+            cur += bytes([c])
+            esc = False
+            continue
+        if c == b'/'[0]:
+            fields.append(cur)
+            cur = b''
+        else:
+            cur += bytes([c])
+    fields.append(cur)
+    return fields
+
+def reference_fmt_args(m_type, *args):
+    data = b'/' + m_type.encode('ascii') + b'/'
+    for a in args:
+        if type(a) == int:
+            if a >= 2147483648:
+                return None
+            a = str(a)
+        if type(a) == str:
+            a = a.encode('ascii')
+        a = a.replace(b'\\', b'\\\\').replace(b'/', b'\\/')
+        data += a + b'/'
+    return data
+
+# Payloads as they come out of the line reverser: printable text, with slashes
+# and backslashes at the given rate
+def payload(rng, length, escapes):
+    text = bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz .,\n') for _ in range(length))
+    if escapes:
+        text = bytes(rng.choice(b'/\\') if rng.random() < escapes else c for c in text)
+    return text
+
+def build_packets(rng, count, length, escapes):
+    packets = []
+    for _ in range(count):
+        session, pos = rng.randrange(2 ** 31), rng.randrange(2 ** 31)
+        packets.append((session, pos, payload(rng, length, escapes)))
+    return packets
+
+def bench_codec(seed=39, count=200):
+    rng = random.Random(seed)
+    # A data packet must stay under 1000 bytes, escapes included
+    cases = [
+        ('ack', 0, 0),
+        ('data 100 B', 100, 0),
+        ('data 900 B', 900, 0),
+        ('data 450 B, 10% escaped', 450, 0.1),
+        ('data 500 B, all escaped', 480, 1),
+    ]
+    print('codec: %d packets per case' % count)
+    for name, length, escapes in cases:
+        packets = build_packets(rng, count, length, escapes)
+        if length:
+            args = [('data', session, pos, data) for session, pos, data in packets]
+        else:
+            args = [('ack', session, pos) for session, pos, data in packets]
+        encoded = [reference_fmt_args(*a) for a in args]
+        for a, expected in zip(args, encoded):
+            assert challenge_7.fmt_args(*a) == expected, a
+            assert challenge_7.unescape_split(expected) == reference_unescape_split(expected), expected
+        size = sum(map(len, encoded)) / count
+
+        def timed(func, items):
+            return min(timeit.repeat(lambda: [func(*i) for i in items], number=5, repeat=3)) / 5 / count * 1e6
+
+        parse_before = timed(reference_unescape_split, [(e,) for e in encoded])
+        parse_after = timed(challenge_7.unescape_split, [(e,) for e in encoded])
+        fmt_before = timed(reference_fmt_args, args)
+        fmt_after = timed(challenge_7.fmt_args, args)
+        print('  %-26s %4.0f B  parse %7.2f -> %5.2f us (%5.1fx)  format %5.2f -> %5.2f us (%4.1fx)' % (
+            name, size, parse_before, parse_after, parse_before / parse_after,
+            fmt_before, fmt_after, fmt_before / fmt_after))
+
+# Link that delays packets (by up to `jitter` more, reordering them) and drops
+# them at random, run on virtual time; challenge_7 reads the same clock while
+# this is in use
+class Link:
+    def __init__(self, rng, delay, loss, jitter=0):
+        self.rng = rng
+        self.delay = delay
+        self.loss = loss
+        self.jitter = jitter
+        self.now = 0.0
+        self.events = []  # Heap of (arrival time, seq, handler, packet)
+        self.seq = itertools.count()
+
+    def clock(self):
+        return self.now
+
+    def send(self, handler, packet, lossy=True):
+        if lossy and self.rng.random() < self.loss:
+            return
+        delay = self.delay + self.rng.uniform(0, self.jitter) if self.jitter else self.delay
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), handler, packet))
+
+    # Advance to the next packet arrival, server timer or client deadline, whichever is first
+    def step(self, deadline=None):
+        due = self.events[0][0] if self.events else float('inf')
+        if deadline is not None:
+            due = min(due, deadline)
+        timeout = challenge_7.next_timeout()
+        if timeout is not None:
+            due = min(due, self.now + timeout)
+        self.now = due
+        while self.events and self.events[0][0] <= self.now:
+            _, _, handler, packet = heapq.heappop(self.events)
+            handler(packet)
+        challenge_7.flush_acks()
+        challenge_7.tick()
+
+# The server's socket, delivering to the client over the link
+class LinkSocket:
+    def __init__(self, link, client):
+        self.link = link
+        self.client = client
+        self.data_packets = 0
+
+    def sendto(self, packet, address):
+        if packet.startswith(b'/data/'):
+            self.data_packets += 1
+        self.link.send(self.client.receive, packet)
+
+# Client reading the reversed line in order and acking cumulatively over the link
+class Client:
+    ADDRESS = ('127.0.0.1', 7)
+
+    def __init__(self, link, session):
+        self.link = link
+        self.session = session
+        self.received = bytearray()
+        self.sock = LinkSocket(link, self)
+
+    def to_server(self, packet):
+        challenge_7.recv_packet(self.sock, packet, self.ADDRESS)
+
+    def receive(self, packet):
+        fields = challenge_7.unescape_split(packet)
+        if fields[1] != b'data':
+            return
+        pos, data = int(fields[3]), fields[4]
+        if pos <= len(self.received) < pos + len(data):
+            self.received += data[len(self.received) - pos:]
+        self.link.send(self.to_server, challenge_7.fmt_args('ack', self.session, len(self.received)))
+
+def run_window(window, line, delay, loss, seed):
+    challenge_7.sessions.clear()
+    challenge_7.timers.clear()
+    challenge_7.Session.WINDOW = window
+    link = Link(random.Random(seed), delay, loss)
+    challenge_7.clock = link.clock
+    client = Client(link, 1)
+    expected = line[::-1] + b'\n'
+    # The upload is not what is measured, so it is delivered without loss
+    link.send(client.to_server, challenge_7.fmt_args('connect', 1), lossy=False)
+    data = line + b'\n'
+    for pos in range(0, len(data), 900):
+        link.send(client.to_server, challenge_7.fmt_args('data', 1, pos, data[pos:pos + 900]), lossy=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        while len(client.received) < len(expected):
+            link.step()
+    assert bytes(client.received) == expected
+    return link.now, client.sock.data_packets
+
+def bench_window(size=200000, delay=0.02, losses=(0, 0.02, 0.1), windows=(1, 4, 8, 32), seed=40):
+    rng = random.Random(seed)
+    line = payload(rng, size, 0.01).replace(b'\n', b' ')
+    segments = -(-size // challenge_7.Session.SEGMENT_SIZE)
+    print('window: %d KB line reversed over a %d ms RTT link, virtual time' % (size // 1000, delay * 2000))
+    clock = challenge_7.clock
+    window = challenge_7.Session.WINDOW
+    try:
+        for loss in losses:
+            for w in windows:
+                elapsed, packets = run_window(w, line, delay, loss, seed)
+                print('  loss %3.0f%%  window %2d  %6.2fs  %7.1f KB/s  %4d data packets (%d+ segments)' % (
+                    loss * 100, w, elapsed, size / elapsed / 1000, packets, segments))
+    finally:
+        challenge_7.clock = clock
+        challenge_7.Session.WINDOW = window
+
+# Session buffers as they were before the chunk list: every ack and every
+# received packet copied the whole outstanding buffer
+class ReferenceBuffers:
+    def __init__(self):
+        self.send_buf = b''
+        self.send_ack_len = 0
+        self.recv_buf = b''
+        self.recv_len = 0
+        self.lines = 0
+
+    def send_data(self, data):
+        self.send_buf += data
+
+    def on_ack(self, l):
+        self.send_buf = self.send_buf[l - self.send_ack_len:]
+        self.send_ack_len = l
+
+    def segment_at(self, pos):
+        return self.send_buf[pos - self.send_ack_len:pos - self.send_ack_len + 950]
+
+    def on_data(self, data, pos):
+        new_data = data[self.recv_len - pos:]
+        self.recv_len += len(new_data)
+        self.recv_buf += new_data
+
+    def poll(self):
+        if self.recv_buf.find(b'\n') == -1:
+            return
+        spl = self.recv_buf.split(b'\n')
+        self.recv_buf = spl.pop()
+        for line in spl:
+            self.send_data(bytes(reversed(line)) + b'\n')
+
+# A real session with its packets going nowhere
+def quiet_session():
+    session = challenge_7.Session(1, None, None)
+    session.send = lambda *args: None
+    challenge_7.sessions[1] = session
+    return session
+
+def run_send(session, chunks):
+    for chunk in chunks:
+        session.send_data(chunk)
+    start = time.perf_counter()
+    # The peer acks one segment at a time while the rest is still buffered
+    total = sum(map(len, chunks))
+    pos = 0
+    while pos < total:
+        data = session.segment_at(pos)
+        pos += len(data)
+        session.on_ack(pos)
+    return time.perf_counter() - start
+
+def run_recv(session, packets, poll):
+    start = time.perf_counter()
+    pos = 0
+    for packet in packets:
+        session.on_data(packet, pos)
+        pos += len(packet)
+        poll(session)
+    return time.perf_counter() - start
+
+def bench_buffers(size=2000000, seed=41):
+    rng = random.Random(seed)
+    print('buffers: %.0f MB through one session' % (size / 1e6))
+    for name, line_size in (('100 B lines', 100), ('one long line', size)):
+        text = payload(rng, size, 0).replace(b'\n', b' ')
+        lines = [text[i:i + line_size - 1] + b'\n' for i in range(0, size, line_size)]
+        data = b''.join(lines)
+        packets = [data[i:i + 900] for i in range(0, len(data), 900)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            send_before = run_send(ReferenceBuffers(), lines)
+            session = quiet_session()
+            session.WINDOW = 0  # Segments are read by run_send, not sent
+            send_after = run_send(session, lines)
+
+            recv_before = run_recv(ReferenceBuffers(), packets, ReferenceBuffers.poll)
+            session = quiet_session()
+            session.WINDOW = 0
+            recv_after = run_recv(session, packets, lambda s: None)
+            assert session.send_len == len(data)
+        print('  send %-14s %8.1f ms -> %6.1f ms' % (name, send_before * 1000, send_after * 1000))
+        print('  recv %-14s %8.1f ms -> %6.1f ms' % (name, recv_before * 1000, recv_after * 1000))
+    challenge_7.sessions.clear()
+    challenge_7.timers.clear()
+
+# Client uploading a stream with a fixed window that, like most simple peers,
+# resends everything from the last ack when its timer runs out
+class Uploader:
+    ADDRESS = ('127.0.0.1', 8)
+    SEGMENT_SIZE = 900
+
+    def __init__(self, link, session, data, window, rto):
+        self.link = link
+        self.session = session
+        self.data = data
+        self.window = window
+        self.rto = rto
+        self.acked = 0
+        self.next = 0
+        self.deadline = None
+        self.packets = 0
+        self.sock = LinkSocket(link, self)
+
+    def to_server(self, packet):
+        challenge_7.recv_packet(self.sock, packet, self.ADDRESS)
+
+    def pump(self):
+        while self.next < len(self.data) and self.next < self.acked + self.window * self.SEGMENT_SIZE:
+            segment = self.data[self.next:self.next + self.SEGMENT_SIZE]
+            self.link.send(self.to_server, challenge_7.fmt_args('data', self.session, self.next, segment))
+            self.next += len(segment)
+            self.packets += 1
+        if self.deadline is None and self.acked < len(self.data):
+            self.deadline = self.link.now + self.rto
+
+    def receive(self, packet):
+        fields = challenge_7.unescape_split(packet)
+        if fields[1] == b'ack' and int(fields[3]) > self.acked:
+            self.acked = int(fields[3])
+            self.next = max(self.next, self.acked)
+            self.deadline = None
+            self.pump()
+
+    def check_timer(self):
+        if self.deadline is not None and self.link.now >= self.deadline:
+            self.next = self.acked
+            self.deadline = None
+            self.pump()
+
+def run_reorder(max_future, data, window, delay, jitter, loss, seed):
+    challenge_7.sessions.clear()
+    challenge_7.timers.clear()
+    challenge_7.future_bytes = 0
+    challenge_7.Session.MAX_FUTURE = max_future
+    link = Link(random.Random(seed), delay, loss, jitter)
+    challenge_7.clock = link.clock
+    uploader = Uploader(link, 1, data, window, rto=3 * (2 * delay + jitter))
+    link.send(uploader.to_server, challenge_7.fmt_args('connect', 1), lossy=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        link.step()
+        uploader.pump()
+        while uploader.acked < len(data):
+            link.step(uploader.deadline)
+            uploader.check_timer()
+    assert bytes(challenge_7.sessions[1].app.buf) == data
+    return link.now, uploader.packets
+
+# A peer parking as many one-byte segments past a gap as the session will
+# hold, then filling the gap: the merge must not stall the server
+def run_fragments(count):
+    challenge_7.sessions.clear()
+    challenge_7.future_bytes = 0
+    session = quiet_session()
+    for pos in range(1, count + 1):
+        session.on_data(b'x', pos)
+    held = len(session.future)
+    start = time.perf_counter()
+    session.on_data(b'x', 0)
+    elapsed = time.perf_counter() - start
+    assert len(session.app.buf) == held + 1 and not session.future and challenge_7.future_bytes == 0
+    challenge_7.pending_acks.clear()
+    challenge_7.sessions.clear()
+    return held, elapsed
+
+def bench_reorder(size=200000, window=16, delay=0.02, jitter=0.02, losses=(0, 0.02, 0.05), seed=43):
+    rng = random.Random(seed)
+    data = payload(rng, size, 0.01).replace(b'\n', b' ')
+    segments = -(-size // Uploader.SEGMENT_SIZE)
+    print('reorder: %d KB upload, window %d, %d-%d ms one-way delay, virtual time' % (
+        size // 1000, window, delay * 1000, (delay + jitter) * 1000))
+    clock = challenge_7.clock
+    max_future = challenge_7.Session.MAX_FUTURE
+    try:
+        for loss in losses:
+            for name, limit in (('dropped', 0), ('reassembled', max_future)):
+                elapsed, packets = run_reorder(limit, data, window, delay, jitter, loss, seed)
+                print('  loss %2.0f%%  future data %-11s %6.2fs  %5d data packets, %5d resent' % (
+                    loss * 100, name, elapsed, packets, packets - segments))
+    finally:
+        challenge_7.clock = clock
+        challenge_7.Session.MAX_FUTURE = max_future
+    held, elapsed = run_fragments(65536)
+    print('  65536 one-byte segments past a gap: %d held, merged in %.2f ms' % (held, elapsed * 1000))
+
+def start_server(*args):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'challenge_7.py')
+    process = subprocess.Popen([sys.executable, script, str(port)] + list(args), stdout=subprocess.DEVNULL)
+    return process, ('127.0.0.1', port)
+
+# Blast bursts of data packets at a server and wait until every session's
+# last packet is acked; packets/s counts the data packets the server took in
+def run_throughput(address, duration, sessions, burst, first=1):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.settimeout(0.5)
+    while True:
+        sock.sendto(b'/connect/%d/' % first, address)
+        try:
+            sock.recvfrom(2000)
+            break
+        except socket.timeout:
+            pass  # Server still starting
+    ids = range(first, first + sessions)
+    for session in ids:
+        sock.sendto(b'/connect/%d/' % session, address)
+    sent = dict.fromkeys(ids, 0)
+    acked = dict.fromkeys(ids, 0)
+    payload = b'x' * 100  # No newline, so the server only acks
+    packets = acks = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for i in range(burst):
+            session = first + (packets + i) % sessions
+            sock.sendto(b'/data/%d/%d/%s/' % (session, sent[session], payload), address)
+            sent[session] += len(payload)
+        packets += burst
+        while acked != sent:
+            try:
+                reply = sock.recvfrom(2000)[0]
+            except socket.timeout:
+                # Dropped somewhere; resend what each session is missing
+                for session in ids:
+                    missing = min(sent[session] - acked[session], 900)
+                    if missing:
+                        sock.sendto(b'/data/%d/%d/%s/' % (session, acked[session], b'x' * missing), address)
+                continue
+            fields = reply.split(b'/')
+            if fields[1] == b'ack':
+                acks += 1
+                acked[int(fields[2])] = max(acked[int(fields[2])], int(fields[3]))
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return packets, acks, elapsed
+
+def throughput_client(conn, *args):
+    conn.send(run_throughput(*args))
+
+def bench_throughput(duration=3.0, sessions=32, burst=64, clients=None):
+    # One client process can saturate one server process, so use several
+    clients = clients or max(1, (os.cpu_count() or 1) // 2)
+    print('throughput: %d client(s) x %d sessions, bursts of %d data packets, %.0fs per run, %d CPU(s)' % (
+        clients, sessions, burst, duration, os.cpu_count() or 1))
+    runs = [
+        ('one per wakeup', ['--batch', '1']),
+        ('batches of 256', []),
+        ('2 workers', ['--workers', '2']),
+        ('4 workers', ['--workers', '4']),
+    ]
+    for label, args in runs:
+        process, address = start_server(*args)
+        try:
+            pipes = []
+            for i in range(clients):
+                parent, child = multiprocessing.Pipe()
+                client = multiprocessing.Process(target=throughput_client, args=(
+                    child, address, duration, sessions, burst, 1 + i * sessions))
+                client.start()
+                pipes.append((client, parent))
+            results = []
+            for client, parent in pipes:
+                results.append(parent.recv())
+                client.join()
+        finally:
+            process.terminate()
+            process.wait()
+        packets = sum(r[0] for r in results)
+        acks = sum(r[1] for r in results)
+        elapsed = max(r[2] for r in results)
+        print('  %-16s %8.0f packets/s  %.2f acks per packet' % (label, packets / elapsed, acks / packets))
+
+BENCHES = {
+    'codec': bench_codec,
+    'window': bench_window,
+    'buffers': bench_buffers,
+    'throughput': bench_throughput,
+    'reorder': bench_reorder,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
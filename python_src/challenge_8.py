@@ -1,61 +1,40 @@
-# Import namedtuple from collections to create simple data classes
-from collections import namedtuple
-# Import random for generating random bytes in testing cipher operations
-import random
+# Import namedtuple from collections to create simple data classes, and
+# OrderedDict for the least recently used cache of ciphers
+from collections import namedtuple, OrderedDict
 # Import socketserver to create a TCP server with threaded request handling
 import socketserver
+# Import threading for the locks guarding the cipher cache and batch decoder
+import threading
 
-# Define a namedtuple called Function with fields 'encode' and 'decode' for cipher operations
-Function = namedtuple('Function', 'encode decode')
+# NumPy is optional; without it batches are decoded one session at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Define a namedtuple called Function: 'table' maps a stream position (mod 256)
+# to the 256-byte translation table the operation applies at that position,
+# and 'positional' says whether the table depends on the position at all
+Function = namedtuple('Function', 'table positional')
 
 # Custom exception class for protocol-related errors
 class ProtocolError(Exception):
     # Inherits from Exception, no additional implementation needed
     pass
 
-# Factory function to create symmetric or asymmetric Function tuples for encoding/decoding
-def reverse(symmetric=False, decode=None):
-    # Assert that if symmetric, no separate decode is provided, and vice versa
-    assert (symmetric and decode is None) or (not symmetric and decode)
-    # Inner decorator function that wraps the provided function
-    def decorator(func):
-        # If symmetric, use the same function for both encode and decode
-        if symmetric:
-            return Function(encode=func, decode=func)
-        # Otherwise, use the provided func as encode and the given decode
-        return Function(encode=func, decode=decode)
-    # Return the decorator
-    return decorator
-
-# Class containing static methods for various cipher operations
+# Translation table that leaves every byte unchanged
+IDENTITY = bytes(range(256))
+# Table reversing the bits of each byte value
+REVERSED_BITS = bytes(int('{:08b}'.format(v)[::-1], 2) for v in range(256))
+# Tables XORing with, and adding (mod 256), each possible operand
+XOR_TABLES = [bytes(v ^ n for v in range(256)) for n in range(256)]
+ADD_TABLES = [bytes((v + n) & 0xFF for v in range(256)) for n in range(256)]
+
+# Class containing the cipher operations, each described by its tables
 class OP:
 
-    # Static method for reversing bits in each byte of the message
-    @staticmethod
-    # Use the reverse decorator to make this symmetric (same for encode/decode)
-    @reverse(symmetric=True)
-    def reversebits(msg, pos):
-        # Loop through each byte in the message
-        for i in range(len(msg)):
-            v = msg[i]  # Get the current byte value
-            new = 0  # Initialize new byte value
-            # Manually reverse the bits by shifting and masking
-            new = (v & 1) << 7
-            v >>= 1
-            new |= (v & 1) << 6
-            v >>= 1
-            new |= (v & 1) << 5
-            v >>= 1
-            new |= (v & 1) << 4
-            v >>= 1
-            new |= (v & 1) << 3
-            v >>= 1
-            new |= (v & 1) << 2
-            v >>= 1
-            new |= (v & 1) << 1
-            v >>= 1
-            new |= v
-            msg[i] = new  # Update the byte in the message
+    # Reverse the bits in each byte; the same at every position
+    reversebits = Function(table=lambda pos: REVERSED_BITS, positional=False)
 
     # Static method to create an XOR operation with a fixed value
     @staticmethod
@@ -63,25 +42,11 @@ class OP:
         # If XOR value is 0, it's a no-op, return None
         if xor == 0:
             return None  # no-op
-        # Define the XOR function (symmetric)
-        def func(msg, pos):
-            # XOR each byte with the fixed value
-            for i in range(len(msg)):
-                msg[i] ^= xor
-        # Return a Function with the same func for encode and decode
-        return Function(encode=func, decode=func)
-
-    # Static method for position-based XOR operation
-    @staticmethod
-    # Use reverse decorator for symmetric operation
-    @reverse(symmetric=True)
-    def xorpos(msg, pos):
-        # Loop through each byte
-        for i in range(len(msg)):
-            # Calculate stream position
-            stream_pos = i + pos
-            # XOR with lower 8 bits of stream_pos
-            msg[i] ^= stream_pos & 0xFF
+        # XOR with the fixed value at every position
+        return Function(table=lambda pos: XOR_TABLES[xor], positional=False)
+
+    # XOR with the lower 8 bits of the stream position
+    xorpos = Function(table=XOR_TABLES.__getitem__, positional=True)
 
     # Static method to create an add operation with a fixed value
     @staticmethod
@@ -89,41 +54,19 @@ class OP:
         # If add value is 0, it's a no-op, return None
         if add == 0:
             return None  # no-op
-        # Define encode function: add the value modulo 256
-        def encode(msg, pos):
-            for i in range(len(msg)):
-                msg[i] = (msg[i] + add) & 0xFF
-        # Define decode function: subtract the value modulo 256
-        def decode(msg, pos):
-            for i in range(len(msg)):
-                msg[i] = (msg[i] - add) & 0xFF
-        # Return Function with encode and decode
-        return Function(encode=encode, decode=decode)
-
-    # Separate decode function for position-based add (since it's asymmetric)
-    def decode_addpos(msg, pos):
-        # Loop through each byte
-        for i in range(len(msg)):
-            # Calculate stream position
-            stream_pos = i + pos
-            # Subtract stream_pos modulo 256
-            msg[i] = (msg[i] - stream_pos) & 0xFF
-
-    # Static method for position-based add operation
-    @staticmethod
-    # Use reverse decorator with custom decode
-    @reverse(decode=decode_addpos)
-    def addpos(msg, pos):
-        # Loop through each byte
-        for i in range(len(msg)):
-            # Calculate stream position
-            stream_pos = i + pos
-            # Add stream_pos modulo 256
-            msg[i] = (msg[i] + stream_pos) & 0xFF
-
-# Class to represent a composed cipher from multiple operations
+        # Add the fixed value modulo 256 at every position
+        return Function(table=lambda pos: ADD_TABLES[add], positional=False)
+
+    # Add the stream position modulo 256
+    addpos = Function(table=ADD_TABLES.__getitem__, positional=True)
+
+# Class to represent a composed cipher, compiled into translation tables
 class Cipher:
 
+    # Messages shorter than this are translated byte by byte; longer ones one
+    # position class (every 256th byte) at a time
+    SHORT_MESSAGE = 1536
+
     # Static method to create (bake) a cipher from a list of operations
     @staticmethod
     def bake(operations):
@@ -132,50 +75,205 @@ class Cipher:
         # If no operations left, return None
         if not operations:
             return None
-        # Collect encode functions in order
-        encode = tuple(op.encode for op in operations)
-        # Collect decode functions and reverse their order
-        decode = [op.decode for op in operations]
-        decode.reverse()
-        # Create the Cipher instance
-        cipher = Cipher(encode, tuple(decode))
-        # Test if the cipher is effectively a no-op
-        # Generate random message for testing
-        randmsg = bytes(random.getrandbits(8) for _ in range(200))
-        # If encoding doesn't change the message, it's a no-op
-        if cipher.encode(randmsg, 0) == randmsg:
+        # A cipher without position-dependent operations needs a single table
+        positional = any(op.positional for op in operations)
+        classes = range(256) if positional else range(1)
+        # Compose the operations' tables, in order, for each position class
+        encode = []
+        for k in classes:
+            table = IDENTITY
+            for op in operations:
+                table = table.translate(op.table(k))
+            encode.append(table)
+        # The cipher is a no-op exactly when it leaves every byte unchanged at
+        # every position
+        if all(table == IDENTITY for table in encode):
             return None
-        # Return the cipher if it's effective
-        return cipher
+        # Positional operations can cancel out (xorpos twice); then one table will do
+        if encode.count(encode[0]) == len(encode):
+            encode = encode[:1]
+        # Every operation is a bijection, so each table can be inverted: the
+        # decode table maps each encoded byte back to the value it came from
+        decode = [bytes.maketrans(table, IDENTITY) for table in encode]
+        # Create the Cipher instance
+        return Cipher(tuple(encode), tuple(decode))
 
-    # Initialize the Cipher with encode and decode operation lists
+    # Initialize the Cipher with its encode and decode tables
     def __init__(self, encode, decode):
-        self.encode_ops = encode  # Tuple of encode functions
-        self.decode_ops = decode  # Tuple of decode functions
+        self.encode_tables = encode  # One table, or one per position mod 256
+        self.decode_tables = decode  # Inverses of the encode tables
+        self.decode_matrix = None  # Decode tables as a NumPy array, built on first use
 
     # Encode a message starting from a position
     def encode(self, msg, pos):
-        # Convert to bytearray for mutability
-        msg = bytearray(msg)
-        # Apply each encode operation in order
-        for op in self.encode_ops:
-            op(msg, pos)
-        # Convert back to bytes and return
-        return bytes(msg)
+        return self.translate(self.encode_tables, msg, pos)
 
     # Decode a message starting from a position
     def decode(self, msg, pos):
-        # Convert to bytearray for mutability
-        msg = bytearray(msg)
-        # Apply each decode operation in reverse order
-        for op in self.decode_ops:
-            op(msg, pos)
-        # Convert back to bytes and return
-        return bytes(msg)
+        return self.translate(self.decode_tables, msg, pos)
+
+    # Apply per-position tables to a message starting at a stream position
+    def translate(self, tables, msg, pos):
+        # Position-independent cipher: one pass over the whole message
+        if len(tables) == 1:
+            return bytes(msg).translate(tables[0])
+        # Short message: look each byte up in its position's table
+        if len(msg) < self.SHORT_MESSAGE:
+            return bytes([tables[(pos + i) & 0xFF][v] for i, v in enumerate(msg)])
+        # Long message: bytes 256 apart share a table, so translate each
+        # position class in one call
+        out = bytearray(len(msg))
+        for k in range(256):
+            out[k::256] = msg[k::256].translate(tables[(pos + k) & 0xFF])
+        return bytes(out)
+
+# Least recently used cache of baked ciphers, keyed by the raw spec bytes
+class CipherCache:
+
+    # Ciphers kept; a positional cipher holds 128 KiB of tables
+    SIZE = 256
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.ciphers = OrderedDict()  # Spec bytes -> Cipher, or None for a no-op
+        self.lock = threading.Lock()  # Connections look ciphers up concurrently
+        self.hits = 0  # Lookups answered from the cache
+        self.misses = 0  # Lookups that had to bake
+
+    # Return the cipher for a spec, baking its operations on a miss
+    def get(self, spec, operations):
+        with self.lock:
+            if spec in self.ciphers:
+                self.hits += 1
+                self.ciphers.move_to_end(spec)
+                return self.ciphers[spec]
+            self.misses += 1
+        # Bake outside the lock so other connections are not held up; two
+        # connections racing on a new spec just bake it twice
+        cipher = Cipher.bake(operations)
+        with self.lock:
+            self.ciphers[spec] = cipher
+            self.ciphers.move_to_end(spec)
+            # Evict the least recently used cipher
+            if len(self.ciphers) > self.size:
+                self.ciphers.popitem(last=False)
+        return cipher
+
+    # Fraction of lookups answered from the cache
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# Ciphers shared by all connections
+ciphers = CipherCache()
+
+# Decode a batch of [cipher, data, pos, result] jobs one at a time
+def decode_each(jobs):
+    for job in jobs:
+        job[3] = job[0].decode(job[1], job[2])
+
+# A NumPy lookup costs more than Cipher.translate for positional chunks
+# totalling fewer bytes than VECTOR_MIN, or single chunks over VECTOR_MAX
+VECTOR_MIN = 192
+VECTOR_MAX = 16384
+
+# Decode a batch of jobs with one vectorized table lookup per cipher; only
+# positional ciphers gain from it, the rest are translated
+def decode_vectorized(jobs):
+    groups = {}  # Cipher -> its positional jobs
+    for job in jobs:
+        cipher = job[0]
+        if len(cipher.decode_tables) == 1 or len(job[1]) > VECTOR_MAX:
+            job[3] = cipher.decode(job[1], job[2])
+        else:
+            groups.setdefault(cipher, []).append(job)
+    for cipher, group in groups.items():
+        if sum([len(job[1]) for job in group]) < VECTOR_MIN:
+            decode_each(group)
+            continue
+        if cipher.decode_matrix is None:
+            cipher.decode_matrix = numpy.frombuffer(b''.join(cipher.decode_tables), dtype=numpy.uint8).reshape(256, 256)
+        # Gather the chunks of every session into one array
+        data = numpy.frombuffer(b''.join([job[1] for job in group]), dtype=numpy.uint8)
+        lengths = numpy.array([len(job[1]) for job in group])
+        starts = numpy.cumsum(lengths) - lengths
+        # Position class of every byte: its chunk's stream offset plus its
+        # index within the chunk, mod 256
+        offsets = numpy.array([job[2] & 0xFF for job in group]) - starts
+        rows = (numpy.arange(len(data)) + numpy.repeat(offsets, lengths)) & 0xFF
+        out = cipher.decode_matrix[rows, data].tobytes()
+        # Scatter the decoded chunks back to their sessions
+        for job, start, length in zip(group, starts.tolist(), lengths.tolist()):
+            job[3] = out[start:start + length]
+
+# Decodes chunks for many connections together: each connection queues its
+# chunk, and whichever thread gets the combiner lock decodes everything
+# queued so far in one batch
+class BatchDecoder:
+
+    def __init__(self, engine=None):
+        # Vectorize when NumPy is there
+        self.engine = engine or (decode_vectorized if numpy else decode_each)
+        self.pending = []  # Jobs waiting to be decoded
+        self.lock = threading.Lock()  # Guards pending
+        self.combiner = threading.Lock()  # Held by the thread decoding a batch
+        self.batches = 0  # Batches decoded
+        self.jobs = 0  # Chunks decoded in them
+        self.alone = 0  # Chunks decoded straight away, with nothing to batch
+
+    # Decode one connection's chunk starting at a stream position
+    def decode(self, cipher, data, pos):
+        # Nothing queued and no batch running: there is nothing to batch with
+        if not self.pending and self.combiner.acquire(blocking=False):
+            try:
+                self.alone += 1
+                return cipher.decode(data, pos)
+            finally:
+                self.combiner.release()
+        job = [cipher, data, pos, None]
+        with self.lock:
+            self.pending.append(job)
+        with self.combiner:
+            # Another thread may have decoded this chunk while we waited
+            if job[3] is None:
+                with self.lock:
+                    batch, self.pending = self.pending, []
+                self.engine(batch)
+                self.batches += 1
+                self.jobs += len(batch)
+        return job[3]
+
+# Batch decoder shared by all connections, set by --batch-decode; by default
+# each connection decodes on its own, which measures no slower under threads
+decoder = None
+
+# Answer a toy request line such as b'10x toy car,15x dog on a string' with
+# the toy of the highest quantity, the first of equal ones, as b'15x dog on a
+# string\n'; None if the line is empty or malformed
+def best_toy(line):
+    line = line.strip()
+    if not line:
+        return None
+    items = line.split(b',')
+    # The quantity runs up to the first 'x' of each item
+    try:
+        quantities = list(map(int, [item.partition(b'x')[0] for item in items]))
+    except ValueError:
+        return None
+    best = max(quantities)
+    # No quantity above zero: nothing to pick
+    if best <= 0:
+        return b'0x None\n'
+    item = items[quantities.index(best)]
+    # The toy name follows the 'x' and a space
+    return b'%dx %s\n' % (best, item[item.find(b'x') + 2:])
 
 # Handler class for socketserver to manage client connections
 class Handler(socketserver.BaseRequestHandler):
 
+    # Bytes to ask the socket for at a time
+    RECV_SIZE = 65536
+
     # Main handle method for the connection
     def handle(self):
         try:
@@ -196,37 +294,28 @@ class Handler(socketserver.BaseRequestHandler):
         # Initialize input and output positions for streaming ciphers
         self.in_pos = 0
         self.out_pos = 0
+        # Decoded bytes of the line still being received
+        self.data = bytearray()
 
         try:
-            # Main loop to process requests
+            # Main loop to process requests, one received batch of lines at a time
             while True:
-                max_qty = 0  # Track maximum quantity
-                max_toy = None  # Track toy with max quantity
-                # Read a line from the client
-                line = self.read_line().decode('ascii').strip()
-                # If empty line, protocol error
-                if not line:
+                lines = self.read_lines()
+                replies = []  # Responses to send for this batch
+                # Process each line
+                for line in lines:
+                    reply = best_toy(line)
+                    # If the line is empty or malformed, stop; it is a protocol
+                    # error once the lines before it are answered
+                    if reply is None:
+                        break
+                    replies.append(reply)
+                # Answer the whole batch in one encrypted write
+                if replies:
+                    self.write(b''.join(replies))
+                # A line was empty
+                if len(replies) < len(lines):
                     raise ProtocolError()
-                # Print received line for debugging
-                print("Recv", line)
-                # Split requests by comma
-                requests = line.split(',')
-                # Process each request
-                for req in requests:
-                    # Find 'x' separator
-                    idx = req.index('x')
-                    # Parse quantity
-                    qty = int(req[:idx])
-                    # Parse toy name (skip space after 'x ')
-                    toy = req[idx + 2:]
-                    # Update max if this qty is higher
-                    if qty > max_qty:
-                        max_qty = qty
-                        max_toy = toy
-                # Print sent response for debugging
-                print("Send", (max_qty, max_toy))
-                # Write the response in format 'qtyx toy\n'
-                self.write('%dx %s\n' % (max_qty, max_toy))
 
         except ProtocolError:
             # Silently handle protocol errors by closing
@@ -235,28 +324,53 @@ class Handler(socketserver.BaseRequestHandler):
         # Close the connection
         self.request.close()
 
-    # Read a line from the client, decoding with cipher
-    def read_line(self):
-        data = b''  # Buffer for data
+    # Receive the next chunk of encrypted bytes from the client
+    def recv_chunk(self):
+        chunk = self.request.recv(self.RECV_SIZE)
+        # If no data, protocol error (unexpected EOF)
+        if not chunk:
+            raise ProtocolError()
+        return chunk
+
+    # Read one byte of the cipher spec from the client
+    def read_byte(self):
+        # Refill the buffer once everything in it is consumed
+        if self.raw_pos == len(self.raw):
+            self.raw = self.recv_chunk()
+            self.raw_pos = 0
+        byte = self.raw[self.raw_pos]
+        self.raw_pos += 1
+        # Collect the spec bytes as the cache key
+        self.spec.append(byte)
+        return byte
+
+    # Read every complete line the client has sent so far, decoding with cipher
+    def read_lines(self):
+        # Start with whatever arrived after the cipher spec
+        enc = self.raw[self.raw_pos:]
+        self.raw = b''
+        self.raw_pos = 0
         while True:
-            # Receive one byte (encrypted)
-            enc = self.request.recv(1)
-            # If no data, protocol error (unexpected EOF)
-            if not enc:
-                raise ProtocolError()
-            # Decode the byte
-            val = self.cipher.decode(enc, self.in_pos)
-            data += val  # Append to buffer
-            self.in_pos += 1  # Increment input position
-            # Stop if newline reached
-            if val == b'\n':
-                break
-        return data  # Return the line
+            # Nothing left over (always so after the first call): nothing to decode
+            if enc:
+                # Decode everything received so far at its stream offset
+                start = len(self.data)
+                if decoder is None:
+                    self.data += self.cipher.decode(enc, self.in_pos)
+                else:
+                    self.data += decoder.decode(self.cipher, enc, self.in_pos)
+                self.in_pos += len(enc)
+                # Only the newly decoded bytes can hold a new newline
+                end = self.data.rfind(b'\n', start)
+                if end >= 0:
+                    # Split out the complete lines and keep the partial one
+                    lines = self.data[:end].split(b'\n')
+                    del self.data[:end + 1]
+                    return lines
+            enc = self.recv_chunk()
 
-    # Write text to the client, encoding with cipher
-    def write(self, text):
-        # Encode text to bytes
-        msg = text.encode('ascii')
+    # Write bytes to the client, encoding with cipher
+    def write(self, msg):
         # Send the encoded message
         self.request.sendall(self.cipher.encode(msg, self.out_pos))
         # Increment output position by message length
@@ -265,9 +379,13 @@ class Handler(socketserver.BaseRequestHandler):
     # Read the cipher specification from the client
     def read_spec(self):
         operations = []  # List of operations
+        # Received bytes, and how many of them the spec has used
+        self.raw = b''
+        self.raw_pos = 0
+        self.spec = bytearray()  # Raw spec bytes
         while True:
             # Read operation code (1 byte)
-            op = self.request.recv(1)[0]
+            op = self.read_byte()
             # 0 terminates the spec
             if op == 0:
                 break
@@ -276,14 +394,14 @@ class Handler(socketserver.BaseRequestHandler):
                 operations.append(OP.reversebits)
             # Operation 2: XOR with operand
             elif op == 2:
-                operand = self.request.recv(1)[0]
+                operand = self.read_byte()
                 operations.append(OP.xor_factory(operand))
             # Operation 3: XOR with position
             elif op == 3:
                 operations.append(OP.xorpos)
             # Operation 4: Add with operand
             elif op == 4:
-                operand = self.request.recv(1)[0]
+                operand = self.read_byte()
                 operations.append(OP.add_factory(operand))
             # Operation 5: Add with position
             elif op == 5:
@@ -291,8 +409,8 @@ class Handler(socketserver.BaseRequestHandler):
             else:
                 # Unknown op, protocol error
                 raise ProtocolError()
-        # Bake the cipher from operations
-        return Cipher.bake(operations)
+        # Reuse the cipher baked for an identical spec, or bake it
+        return ciphers.get(bytes(self.spec), operations)
         
 
 # Custom server class inheriting from ThreadingTCPServer
@@ -300,7 +418,21 @@ class Server(socketserver.ThreadingTCPServer):
     # Allow address reuse for quick restarts
     allow_reuse_address = True
 
-# Create the server on port 40000
-server = Server(('0.0.0.0', 40000), Handler)
-# Run the server forever
-server.serve_forever()
+# Main block
+if __name__ == '__main__':
+    # Import argparse for the command line options
+    import argparse
+    parser = argparse.ArgumentParser()
+    # Opt in to decoding chunks from many connections together with NumPy
+    parser.add_argument("--batch-decode", action="store_true",
+                        help="decode chunks from concurrent connections in NumPy batches")
+    args = parser.parse_args()
+    if args.batch_decode:
+        # The batches only pay off with the vectorized engine
+        if numpy is None:
+            parser.error("--batch-decode needs NumPy")
+        decoder = BatchDecoder()
+    # Create the server on port 40000
+    server = Server(('0.0.0.0', 40000), Handler)
+    # Run the server forever
+    server.serve_forever()
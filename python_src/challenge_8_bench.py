@@ -0,0 +1,341 @@
+# Benchmarks for the challenge 8 insecure sockets layer
+# Run with: python challenge_8_bench.py [cipher] [stream] [bake] [fanin] [toys]
+import random
+import socket
+import sys
+import threading
+import time
+import timeit
+
+import challenge_8
+
+# The per-byte operations and cipher the translation tables replaced, kept
+# as the oracle for the specs below
+def reference_reversebits(msg, pos):
+    for i in range(len(msg)):
+        v = msg[i]
+        new = 0
+        for _ in range(8):
+            new = (new << 1) | (v & 1)
+            v >>= 1
+        msg[i] = new
+
+def reference_xor(xor):
+    def func(msg, pos):
+        for i in range(len(msg)):
+            msg[i] ^= xor
+    return func, func
+
+def reference_xorpos(msg, pos):
+    for i in range(len(msg)):
+        msg[i] ^= (i + pos) & 0xFF
+
+def reference_add(add):
+    def encode(msg, pos):
+        for i in range(len(msg)):
+            msg[i] = (msg[i] + add) & 0xFF
+    def decode(msg, pos):
+        for i in range(len(msg)):
+            msg[i] = (msg[i] - add) & 0xFF
+    return encode, decode
+
+def reference_addpos(msg, pos):
+    for i in range(len(msg)):
+        msg[i] = (msg[i] + i + pos) & 0xFF
+
+def reference_subpos(msg, pos):
+    for i in range(len(msg)):
+        msg[i] = (msg[i] - i - pos) & 0xFF
+
+class ReferenceCipher:
+    def __init__(self, spec):
+        ops = []
+        for op in spec:
+            if op[0] == 1:
+                ops.append((reference_reversebits, reference_reversebits))
+            elif op[0] == 2:
+                ops.append(reference_xor(op[1]))
+            elif op[0] == 3:
+                ops.append((reference_xorpos, reference_xorpos))
+            elif op[0] == 4:
+                ops.append(reference_add(op[1]))
+            else:
+                ops.append((reference_addpos, reference_subpos))
+        self.encode_ops = [e for e, d in ops]
+        self.decode_ops = [d for e, d in reversed(ops)]
+
+    def encode(self, msg, pos):
+        msg = bytearray(msg)
+        for op in self.encode_ops:
+            op(msg, pos)
+        return bytes(msg)
+
+    def decode(self, msg, pos):
+        msg = bytearray(msg)
+        for op in self.decode_ops:
+            op(msg, pos)
+        return bytes(msg)
+
+# Spec as ((op,) or (op, operand)) tuples, and the same spec as challenge_8 operations
+def operations(spec):
+    ops = []
+    for op in spec:
+        if op[0] == 1:
+            ops.append(challenge_8.OP.reversebits)
+        elif op[0] == 2:
+            ops.append(challenge_8.OP.xor_factory(op[1]))
+        elif op[0] == 3:
+            ops.append(challenge_8.OP.xorpos)
+        elif op[0] == 4:
+            ops.append(challenge_8.OP.add_factory(op[1]))
+        else:
+            ops.append(challenge_8.OP.addpos)
+    return ops
+
+def random_spec(rng):
+    spec = []
+    for _ in range(rng.randint(1, 5)):
+        op = rng.randint(1, 5)
+        spec.append((op, rng.randint(1, 255)) if op in (2, 4) else (op,))
+    return spec
+
+def check(seed=46, specs=200):
+    rng = random.Random(seed)
+    checked = 0
+    for _ in range(specs):
+        spec = random_spec(rng)
+        cipher = challenge_8.Cipher.bake(operations(spec))
+        reference = ReferenceCipher(spec)
+        if cipher is None:
+            # Only a spec that changes nothing at any position may be dropped
+            msg = bytes(range(256)) * 2
+            assert all(reference.encode(msg, pos) == msg for pos in range(256)), spec
+            continue
+        for length in (1, 7, 255, 256, 1000, challenge_8.Cipher.SHORT_MESSAGE, 5000):
+            msg = bytes(rng.getrandbits(8) for _ in range(length))
+            pos = rng.randrange(1 << 20)
+            encoded = reference.encode(msg, pos)
+            assert cipher.encode(msg, pos) == encoded, (spec, length, pos)
+            assert cipher.decode(encoded, pos) == msg, (spec, length, pos)
+        checked += 1
+    return checked
+
+SPECS = [
+    ('xor(1),reversebits', [(2, 1), (1,)]),
+    ('addpos,addpos', [(5,), (5,)]),
+    ('xor(123),addpos,reversebits', [(2, 123), (5,), (1,)]),
+]
+
+def throughput(func, msg, pos=12345):
+    number = max(1, 2000000 // (len(msg) * 50))
+    elapsed = min(timeit.repeat(lambda: func(msg, pos), number=number, repeat=3)) / number
+    return len(msg) / elapsed / 1e6
+
+def bench_cipher(sizes=(100, 4096, 65536)):
+    print('cipher: %d random specs identical to the per-byte reference' % check())
+    rng = random.Random(8)
+    for name, spec in SPECS:
+        cipher = challenge_8.Cipher.bake(operations(spec))
+        reference = ReferenceCipher(spec)
+        for size in sizes:
+            msg = bytes(rng.getrandbits(8) for _ in range(size))
+            before = throughput(reference.decode, msg)
+            after = throughput(cipher.decode, msg)
+            print('  %-28s %6d B  decode %6.2f -> %8.2f MB/s (%5.0fx)' % (name, size, before, after, after / before))
+
+# Handler reading one byte per recv call, as the handler did before bulk receive
+class ByteHandler(challenge_8.Handler):
+    def read_lines(self):
+        data = b''
+        while True:
+            # Spec leftovers first, then the socket
+            if self.raw_pos < len(self.raw):
+                enc = self.raw[self.raw_pos:self.raw_pos + 1]
+                self.raw_pos += 1
+            else:
+                enc = self.request.recv(1)
+            if not enc:
+                raise challenge_8.ProtocolError()
+            val = self.cipher.decode(enc, self.in_pos)
+            data += val
+            self.in_pos += 1
+            if val == b'\n':
+                return [data[:-1]]
+
+TOYS = ['toy car', 'dog on a string', 'inflatable motorcycle', 'model train', 'jigsaw puzzle', 'kite']
+
+def toy_lines(rng, count, items):
+    lines = []
+    expected = []
+    for _ in range(count):
+        toys = [(rng.randint(1, 1000), rng.choice(TOYS)) for _ in range(items)]
+        lines.append(','.join('%dx %s' % toy for toy in toys) + '\n')
+        # The first of equal quantities wins
+        best = max(toys, key=lambda toy: toy[0])
+        expected.append('%dx %s\n' % best)
+    return ''.join(lines).encode('ascii'), ''.join(expected).encode('ascii')
+
+def run_stream(handler, spec, payload, expected):
+    server = challenge_8.Server(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cipher = ReferenceCipher(spec) if len(payload) < 100000 else None
+    baked = challenge_8.Cipher.bake(operations(spec))
+    request = (cipher or baked).encode(payload, 0)
+    spec_bytes = bytes(b for op in spec for b in op) + b'\0'
+    try:
+        with socket.create_connection(server.server_address) as sock:
+            start = time.perf_counter()
+            sender = threading.Thread(target=sock.sendall, args=(spec_bytes + request,))
+            sender.start()
+            received = bytearray()
+            while len(received) < len(expected):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+            elapsed = time.perf_counter() - start
+            sender.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert baked.decode(received, 0) == expected, 'replies differ from the expected toys'
+    return len(payload) / elapsed / 1e6
+
+def bench_stream(items=10):
+    rng = random.Random(47)
+    print('stream: lines of %d toys, one connection' % items)
+    for name, spec in SPECS:
+        small = toy_lines(rng, 1000, items)
+        large = toy_lines(rng, 40000, items)
+        before = run_stream(ByteHandler, spec, *small)
+        after = run_stream(challenge_8.Handler, spec, *large)
+        print('  %-28s %6.2f -> %6.2f MB/s (%4.0fx)' % (name, before, after, after / before))
+
+# Specs that change nothing, only some of them at every position
+NO_OPS = [[(2, 1), (2, 1)], [(3,), (3,)], [(1,), (1,)], [(4, 128), (4, 128)], [(2, 160), (1,), (2, 5), (1,)]]
+
+def bench_bake(connections=20000, specs=50, seed=48):
+    for spec in NO_OPS:
+        assert challenge_8.Cipher.bake(operations(spec)) is None, spec
+    print('bake: %d no-op specs detected' % len(NO_OPS))
+    for name, spec in SPECS:
+        elapsed = min(timeit.repeat(lambda: challenge_8.Cipher.bake(operations(spec)), number=20, repeat=3)) / 20
+        print('  %-28s %8.1f us/bake' % (name, elapsed * 1e6))
+    # Connections drawing their spec from a small, skewed set
+    rng = random.Random(seed)
+    pool = [random_spec(rng) for _ in range(specs)]
+    weights = [1 / (i + 1) for i in range(specs)]
+    chosen = rng.choices(pool, weights, k=connections)
+    cache = challenge_8.CipherCache()
+    start = time.perf_counter()
+    for spec in chosen:
+        cache.get(bytes(b for op in spec for b in op) + b'\0', operations(spec))
+    elapsed = time.perf_counter() - start
+    print('  %d connections over %d specs  %6.1f us/lookup  %d hits, %d misses (%.1f%%)' % (
+        connections, specs, elapsed / connections * 1e6, cache.hits, cache.misses, cache.hit_rate() * 100))
+
+def fanin_jobs(rng, ciphers, sessions, low, high):
+    jobs = []
+    for _ in range(sessions):
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(low, high)))
+        jobs.append([rng.choice(ciphers), data, rng.randrange(1 << 20), None])
+    return jobs
+
+def run_engine(engine, jobs, number=20):
+    def run():
+        engine([job[:3] + [None] for job in jobs])
+    elapsed = min(timeit.repeat(run, number=number, repeat=3)) / number
+    return sum(len(job[1]) for job in jobs) / elapsed / 1e6
+
+def fanin_thread(decoder, chunks, results):
+    for cipher, data, pos, _ in chunks:
+        if decoder is None:
+            results.append(cipher.decode(data, pos))
+        else:
+            results.append(decoder.decode(cipher, data, pos))
+
+# Threads decoding concurrently, each on its own or through one batch decoder
+def run_threads(decoder, work):
+    results = [[] for _ in work]
+    workers = [threading.Thread(target=fanin_thread, args=(decoder, chunks, out)) for chunks, out in zip(work, results)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    for chunks, out in zip(work, results):
+        assert out == [job[0].decode(job[1], job[2]) for job in chunks], 'batch decoder results differ'
+    return sum(len(job[1]) for chunks in work for job in chunks) / elapsed / 1e6
+
+def bench_fanin(sessions=2000, threads=64, seed=49):
+    rng = random.Random(seed)
+    ciphers = [challenge_8.Cipher.bake(operations(spec)) for _, spec in SPECS[1:]]
+    ciphers += [challenge_8.Cipher.bake(operations([(5,), (2, n)])) for n in range(1, 3)]
+    print('fanin: %d sessions, %d ciphers, numpy %s' % (
+        sessions, len(ciphers), 'available' if challenge_8.numpy else 'missing'))
+    for low, high in ((16, 64), (64, 256), (256, 1024)):
+        jobs = fanin_jobs(rng, ciphers, sessions, low, high)
+        expected = [job[0].decode(job[1], job[2]) for job in jobs]
+        line = '  %4d-%4d B chunks  one at a time %6.2f MB/s' % (low, high, run_engine(challenge_8.decode_each, jobs))
+        if challenge_8.numpy:
+            batch = [job[:3] + [None] for job in jobs]
+            challenge_8.decode_vectorized(batch)
+            assert [job[3] for job in batch] == expected, 'vectorized decode differs'
+            line += '  vectorized %6.2f MB/s' % run_engine(challenge_8.decode_vectorized, jobs)
+        print(line)
+
+    work = [fanin_jobs(rng, ciphers, sessions // threads * 4, 64, 256) for _ in range(threads)]
+    line = '  %d threads  own decode %6.2f MB/s' % (threads, run_threads(None, work))
+    if challenge_8.numpy:
+        decoder = challenge_8.BatchDecoder()
+        line += '  batch decoder %6.2f MB/s (%d batches of %.1f chunks, %d alone)' % (
+            run_threads(decoder, work), decoder.batches, decoder.jobs / max(1, decoder.batches), decoder.alone)
+    print(line)
+
+# The str-based evaluation best_toy replaced, kept as the oracle
+def reference_best_toy(line):
+    max_qty = 0
+    max_toy = None
+    line = line.decode('ascii').strip()
+    if not line:
+        return None
+    for req in line.split(','):
+        idx = req.index('x')
+        qty = int(req[:idx])
+        toy = req[idx + 2:]
+        if qty > max_qty:
+            max_qty = qty
+            max_toy = toy
+    return ('%dx %s\n' % (max_qty, max_toy)).encode('ascii')
+
+TOY_LINES = [b'', b'  ', b'10x toy car,15x dog on a string,4x inflatable motorcycle',
+             b'5x box, 5x boxes ,7x x', b' 3x a,3x b\t', b'0x nothing', b'1x a']
+
+def bench_toys(lines=200, low=300, high=800, seed=50):
+    rng = random.Random(seed)
+    corpus = list(TOY_LINES)
+    for _ in range(lines):
+        # Small quantities so that ties are common
+        corpus.append(b','.join(b'%dx %s' % (rng.randint(1, rng.choice((50, 100000))), rng.choice(TOYS).encode('ascii'))
+                                for _ in range(rng.randint(low, high))))
+    for line in corpus:
+        assert challenge_8.best_toy(line) == reference_best_toy(line), line
+    items = sum(line.count(b',') + 1 for line in corpus[len(TOY_LINES):])
+    print('toys: %d lines of %d-%d items identical to reference' % (len(corpus), low, high))
+    before = min(timeit.repeat(lambda: [reference_best_toy(line) for line in corpus], number=5, repeat=3)) / 5
+    after = min(timeit.repeat(lambda: [challenge_8.best_toy(line) for line in corpus], number=5, repeat=3)) / 5
+    print('  str evaluation   %6.1f ns/item' % (before / items * 1e9))
+    print('  best_toy         %6.1f ns/item (%.1fx)' % (after / items * 1e9, before / after))
+
+BENCHES = {
+    'cipher': bench_cipher,
+    'stream': bench_stream,
+    'bake': bench_bake,
+    'fanin': bench_fanin,
+    'toys': bench_toys,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()